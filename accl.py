@@ -0,0 +1,174 @@
+"""
+Accelerated Chow-Liu (acCL, Meila 1999) for sparse binary data: the spanning tree is found
+from the co-occurrences of the rare value of each variable, without computing the mutual
+information of most pairs of variables.
+"""
+import heapq
+import numpy as np
+from spanning_tree import Union_Find, kruskal
+
+def rare_values(codes, arities, weights=None, chunk_rows=16384):
+    """
+        Find the less frequent value of every binary variable.
+        codes: N x n matrix of codes (0 or 1).
+        arities: number of values of each variable (at most 2).
+        weights: optional weight of every data point.
+        chunk_rows: number of data points read at a time.
+        return: code of the rare value of each variable and its count.
+    """
+    if np.any(np.asarray(arities) > 2):
+        raise ValueError("sparse training needs binary variables")
+    ones = np.zeros(codes.shape[1])
+    for start in range(0, codes.shape[0], chunk_rows):
+        chunk = codes[start:start + chunk_rows]
+        ones += chunk.sum(axis=0) if weights is None else weights[start:start + chunk_rows].dot(chunk)
+    total = codes.shape[0] if weights is None else np.sum(weights)
+    rare = (ones <= total - ones).astype(np.intp) # code 1 unless it is the majority
+    return rare, np.where(rare == 1, ones, total - ones)
+
+def sparse_rows(codes, rare, chunk_rows=16384):
+    """
+        Keep only the positions of the rare values of every data point (CSR layout).
+        codes: N x n matrix of codes.
+        rare: code of the rare value of each variable.
+        chunk_rows: number of data points read at a time.
+        return: row pointer (N + 1) and column index vectors; the rare values of data
+            point r are the variables indices[indptr[r]:indptr[r + 1]], in increasing order.
+    """
+    indptr, indices = [np.zeros(1, dtype=np.intp)], []
+    for start in range(0, codes.shape[0], chunk_rows):
+        rows, columns = np.nonzero(codes[start:start + chunk_rows] == rare)
+        indptr.append(indptr[-1][-1] + np.cumsum(np.bincount(rows, minlength=min(chunk_rows, codes.shape[0] - start))))
+        indices.append(columns.astype(np.intp))
+    return np.concatenate(indptr), np.concatenate(indices) if indices else np.zeros(0, dtype=np.intp)
+
+def cooccurrences(indptr, indices, n, weights=None):
+    """
+        Count how often the rare values of two variables appear in the same data point,
+        for the pairs that appear together at least once.
+        indptr and indices: sparse rows from sparse_rows.
+        n: number of variables.
+        weights: optional weight of every data point.
+        return: vectors of u < v variable pairs and their (weighted) counts.
+    """
+    sizes = np.diff(indptr)
+    keys, counts = [], []
+    for size in np.unique(sizes[sizes > 1]):
+        # data points with the same number of rare values give a rectangular block of positions
+        rows = np.nonzero(sizes == size)[0]
+        block = indices[indptr[rows][:, None] + np.arange(size)]
+        first, second = np.triu_indices(size, 1)
+        pairs = (block[:, first] * n + block[:, second]).ravel()
+        unique, inverse = np.unique(pairs, return_inverse=True)
+        pair_weights = None if weights is None else np.repeat(weights[rows], len(first))
+        keys.append(unique)
+        counts.append(np.bincount(inverse.ravel(), weights=pair_weights, minlength=len(unique)))
+    if not keys:
+        return np.zeros(0, dtype=np.intp), np.zeros(0, dtype=np.intp), np.zeros(0)
+    unique, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    totals = np.bincount(inverse.ravel(), weights=np.concatenate(counts), minlength=len(unique))
+    return unique // n, unique % n, totals
+
+def binary_mutual_information(together, count_u, count_v, rare_u, rare_v, total):
+    """
+        Mutual information of pairs of binary variables from the counts of their rare values.
+        The 2 x 2 tables are laid out in code order and added up like the dense contingency
+        blocks, so the values are exactly the ones of mutual_information_from_counts.
+        together: number of data points with both rare values.
+        count_u and count_v: counts of the rare values.
+        rare_u and rare_v: codes of the rare values.
+        total: number of data points.
+        return: vector of mutual information values (in bits).
+    """
+    together, count_u, count_v = [np.asarray(x, dtype=float) for x in (together, count_u, count_v)]
+    rare_u, rare_v = np.asarray(rare_u), np.asarray(rare_v)
+    # table[a][b] holds the count of u = a, v = b in code order
+    table = [[None, None], [None, None]]
+    for a in (0, 1):
+        for b in (0, 1):
+            in_u, in_v = (rare_u == a), (rare_v == b) # whether code a (b) is the rare value
+            table[a][b] = np.where(in_u & in_v, together, np.where(in_u, count_u - together,
+                                   np.where(in_v, count_v - together, total - count_u - count_v + together)))
+    marginal_u = [np.where(rare_u == a, count_u, total - count_u) for a in (0, 1)]
+    marginal_v = [np.where(rare_v == b, count_v, total - count_v) for b in (0, 1)]
+    terms = [[None, None], [None, None]]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for a in (0, 1):
+            for b in (0, 1):
+                joint = table[a][b] / total
+                terms[a][b] = np.where(joint > 0, joint * np.log2(joint / ((marginal_u[a] / total) * (marginal_v[b] / total))), 0)
+    return (terms[0][0] + terms[1][0]) + (terms[0][1] + terms[1][1])
+
+def ordered_edges(n, first, second, together, counts, rare, total, components, block=256):
+    """
+        Generate the variable pairs by decreasing mutual information, lazily. The pairs
+        that co-occur are sorted up front; for every variable u, the pairs with a variable v
+        with a rarer value that never co-occurs with u are decreasing in the count of v
+        (Meila's lemma), so each such list is walked in that order through a heap. Pairs
+        already joined by the tree so far are skipped without computing their MI.
+        n: number of variables.
+        first, second and together: co-occurring pairs and their counts.
+        counts and rare: count and code of the rare value of every variable.
+        total: number of data points.
+        components: Union_Find of the tree being built.
+        block: number of list entries checked at a time.
+        return: generator of (mutual information, u, v).
+    """
+    explicit = binary_mutual_information(together, counts[first], counts[second], rare[first], rare[second], total)
+    explicit_order = np.argsort(-explicit, kind='stable')
+    ranking = np.lexsort((np.arange(n), -counts)) # most frequent rare values first
+    position = np.empty(n, dtype=np.intp)
+    position[ranking] = np.arange(n)
+    # positions (in ranking) of the variables co-occurring with each variable, sorted
+    ends = np.concatenate((first, second))
+    others = position[np.concatenate((second, first))]
+    grouped = np.lexsort((others, ends))
+    partners = np.split(others[grouped], np.cumsum(np.bincount(ends, minlength=n))[:-1])
+
+    def head(u, start):
+        # next variable after position start in ranking that is not joined to and never co-occurs with u
+        while start < n:
+            stop = min(start + block, n)
+            candidates = components.labels[ranking[start:stop]] != components.labels[u]
+            inside = partners[u][np.searchsorted(partners[u], start):np.searchsorted(partners[u], stop)]
+            candidates[inside - start] = False
+            found = np.flatnonzero(candidates)
+            if len(found):
+                start += found[0]
+                v = ranking[start]
+                mi = binary_mutual_information(0, counts[u], counts[v], rare[u], rare[v], total)
+                return (-float(mi), int(u), int(start), int(v))
+            start = stop
+        return None
+
+    heap = [entry for entry in (head(u, position[u] + 1) for u in range(n)) if entry is not None]
+    heapq.heapify(heap)
+    next_explicit = 0
+    while heap or next_explicit < len(explicit_order):
+        if next_explicit < len(explicit_order):
+            q = explicit_order[next_explicit]
+            if not heap or explicit[q] >= -heap[0][0]:
+                next_explicit += 1
+                yield float(explicit[q]), int(first[q]), int(second[q])
+                continue
+        mi, u, start, v = heapq.heappop(heap)
+        yield -mi, u, v
+        entry = head(u, start + 1)
+        if entry is not None:
+            heapq.heappush(heap, entry)
+
+def sparse_spanning_tree(codes, arities, weights=None):
+    """
+        Maximum mutual information spanning tree of binary data with acCL.
+        codes: N x n matrix of codes (0 or 1).
+        arities: number of values of each variable (at most 2).
+        weights: optional weight of every data point.
+        return: list with the n - 1 (u, v) edges of the tree.
+    """
+    n = codes.shape[1]
+    total = codes.shape[0] if weights is None else np.sum(weights)
+    rare, counts = rare_values(codes, arities, weights)
+    indptr, indices = sparse_rows(codes, rare)
+    first, second, together = cooccurrences(indptr, indices, n, weights)
+    components = Union_Find(n)
+    return kruskal(ordered_edges(n, first, second, together, counts, rare, total, components), n, components)
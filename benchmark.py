@@ -0,0 +1,141 @@
+"""
+Benchmarks for the hot paths of training and comparing Chow-Liu trees.
+
+    python benchmark.py --output bench.json
+    python benchmark.py --output new.json --baseline bench.json
+"""
+import argparse
+import json
+import platform
+import sys
+import time
+import numpy as np
+from chow_liu_tree import Chow_Liu_Tree
+from dataset import Dataset, load_data
+from experiment import perturb
+from metric import Metric
+
+GRID = [(1000, 10, 2), (1000, 30, 2), (5000, 30, 4), (2000, 100, 2), (20000, 50, 3)] # (rows N, variables n, arity k)
+QUICK_GRID = [(500, 10, 2), (1000, 30, 3)]
+DATA_FILES = ['data/abalone.test.data', 'data/abalone.ts.data']
+
+def synthetic_data(rows, variables, arity, seed=0):
+    """
+        Draw a data set where every variable copies a random earlier one most of the time,
+        so the variables are dependent along a random tree.
+        return: Dataset with the given shape.
+    """
+    rng = np.random.default_rng(seed)
+    codes = rng.integers(0, arity, size=(rows, variables))
+    for var in range(1, variables):
+        copied = rng.random(rows) < 0.7
+        codes[copied, var] = codes[copied, rng.integers(var)]
+    return Dataset(codes, [np.array([str(value) for value in range(arity)])] * variables)
+
+def trained(data):
+    """
+        Build a tree on the data.
+    """
+    clt = Chow_Liu_Tree(data)
+    clt.build_clt()
+    return clt
+
+def measure(setup, operation, repeats):
+    """
+        Time an operation on fresh inputs.
+        setup: function returning the arguments of the operation (not timed).
+        operation: function to time.
+        repeats: number of runs.
+        return: best wall time in seconds.
+    """
+    best = np.inf
+    for _ in range(repeats):
+        arguments = setup()
+        start = time.perf_counter()
+        operation(*arguments)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def iteration(clt, clt2, metric, rng):
+    """
+        One iteration of the main.py perturbation experiment.
+    """
+    metric.conditional_probability_tests(clt, clt2)
+    metric.compare(clt, clt2, ["mid", "jsd", "kld", "joint_jsd"])
+    perturb(clt2, rng)
+
+def benchmark_case(data, repeats):
+    """
+        Time every hot path on one data set.
+        data: Dataset to train on.
+        repeats: number of runs per operation.
+        return: dictionary from operation to best wall time in seconds.
+    """
+    metric = Metric()
+    pair = lambda: (trained(data), trained(data.copy()))
+    results = {
+        'calculate_mutual_information': measure(lambda: (Chow_Liu_Tree(data),), lambda clt: clt.calculate_mutual_information(), repeats),
+        'build_clt': measure(lambda: (Chow_Liu_Tree(data),), lambda clt: clt.build_clt(), repeats),
+        'build_clt_compressed': measure(lambda: (Chow_Liu_Tree(data, compress=True),), lambda clt: clt.build_clt(), repeats),
+        'conditional_probability_tests': measure(pair, metric.conditional_probability_tests, repeats),
+        'iteration': measure(lambda: pair() + (metric, np.random.default_rng(0)), iteration, repeats),
+    }
+    if max(data.arities) <= 2:
+        results['build_clt_sparse'] = measure(lambda: (Chow_Liu_Tree(data, sparse=True),), lambda clt: clt.build_clt(), repeats)
+    for name in ("mid", "jsd", "kld", "joint_kld", "joint_jsd"):
+        results['divergence_' + name] = measure(pair, lambda clt1, clt2: metric.divergence(clt1, clt2, name), repeats)
+    return results
+
+def run(grid, files, repeats):
+    """
+        Run the benchmarks on the synthetic grid and the data files.
+        return: JSON-serializable report.
+    """
+    cases = [('synthetic N=%d n=%d k=%d' % shape, lambda shape=shape: synthetic_data(*shape)) for shape in grid]
+    cases += [(path, lambda path=path: load_data(path)) for path in files]
+    results = {}
+    for name, load in cases:
+        results[name] = benchmark_case(load(), repeats)
+        print("%-40s %s" % (name, " ".join("%s=%.4f" % item for item in sorted(results[name].items()))))
+    return {'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                     'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'repeats': repeats},
+            'results': results}
+
+def compare(report, baseline, tolerance, noise):
+    """
+        Find the operations that got slower than the baseline.
+        report and baseline: reports written by run.
+        tolerance: allowed ratio of new to baseline time.
+        noise: differences below this many seconds are ignored.
+        return: list of (case, operation, baseline time, new time) regressions.
+    """
+    regressions = []
+    for case, operations in report['results'].items():
+        for operation, seconds in operations.items():
+            before = baseline['results'].get(case, {}).get(operation)
+            if before is None:
+                continue
+            ratio = seconds / before if before > 0 else np.inf
+            print("%-40s %-32s %9.4f -> %9.4f  x%.2f" % (case, operation, before, seconds, ratio))
+            if ratio > tolerance and seconds - before > noise:
+                regressions.append((case, operation, before, seconds))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Chow-Liu tree training and comparison.")
+    parser.add_argument('--output', default='bench.json', help="where to write the JSON report")
+    parser.add_argument('--baseline', help="JSON report to compare against")
+    parser.add_argument('--tolerance', type=float, default=1.25, help="allowed slowdown ratio")
+    parser.add_argument('--noise', type=float, default=0.001, help="ignore slowdowns below this many seconds")
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--quick', action='store_true', help="small grid and no data files")
+    args = parser.parse_args()
+    report = run(QUICK_GRID if args.quick else GRID, [] if args.quick else DATA_FILES, args.repeats)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance, args.noise)
+        for case, operation, before, seconds in regressions:
+            print("REGRESSION %s %s: %.4fs -> %.4fs" % (case, operation, before, seconds))
+        sys.exit(1 if regressions else 0)
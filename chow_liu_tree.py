@@ -5,21 +5,93 @@ Author: Jose Gonzalez
 Date: July 2017
 """
 import numpy as np
-import networkx as nx
-import matplotlib.pyplot as plt
+from counts import Count_Store, table_mutual_information
+from dataset import MAGIC, Dataset, as_dataset, code_dtype, load_binary, read_arrays, recode, write_arrays, write_header
+from spanning_tree import maximum_spanning_tree, orient_tree
+from accl import sparse_spanning_tree
+from inference import Belief_Propagation, ancestral_sample, cumulative_cpts, tree_log_likelihood
+from profiling import profiled, stats
+
+MODEL_MAGIC = b'CLTMODL1' # first bytes of a saved tree
 
 class Chow_Liu_Tree:
-    def __init__(self, X=None, mi_vec=np.array([]), testing=False):
+    def __init__(self, X=None, mi_vec=np.array([]), testing=False, window=None, decay=None, root='0', compress=False, sparse=False, alpha=0.0, max_dense=2048):
         """
             Initialization function
-            X: data set.
+            X: data set, a Dataset or a dictionary of value lists keyed by '0', '1', ...
             mi_vec: mutual information vector with MI values between all variables.
             testing: testing flag.
+            window: if given, the tree only learns from the last window data points.
+            decay: if given, every new data point fades older ones by this factor.
+            root: variable the edges of the tree point away from.
+            compress: count every distinct data point once, weighted by its number of copies.
+            sparse: binary data with a rare value per variable: find the tree with acCL from the
+                co-occurrences of the rare values, never computing the full MI matrix, and keep
+                only the pairwise counts of the tree edges.
+            alpha: Laplace smoothing added to every count of the CPTs (0 for maximum likelihood).
+            max_dense: largest number of (variable, value) indicators for which every pairwise
+                table is kept (see Count_Store); update, evict and replace need all of them.
         """
         self.X = X
         self.mi_vec = mi_vec
+        self.mi_matrix = None
         self.testing = testing
-        self.tree = nx.DiGraph() 
+        self._tree = None # networkx view of the tree, built on first use
+        self.window = window
+        self.decay = decay
+        self.root = int(root)
+        self.compress = compress
+        self.sparse = sparse
+        self.alpha = alpha
+        self.max_dense = max_dense
+        self.parents = None # parent of each variable, -1 for the root
+        self.order = None # variables in topological order
+        self.cpts = None # root marginal and p(child | parent) table of every other variable
+        self.vocab = None # values behind the codes the CPTs are indexed by
+        self._log_cpts = None
+        self._inference = None
+        self._distributions = None
+        self._counts = None
+
+    @property
+    def counts(self):
+        """
+            Count store with the sufficient statistics of X, built on first use.
+        """
+        if self._counts is None:
+            if self.X is None:
+                raise ValueError("the tree has no data to count (it was loaded or built without X)")
+            with stats.phase('counts'):
+                data = as_dataset(self.X)
+                if self.compress:
+                    data = data.compress()
+                max_dense = 0 if self.sparse else self.max_dense # sparse training never needs every pairwise table
+                self._counts = Count_Store.from_dataset(data, window=self.window, decay=self.decay, max_dense=max_dense)
+        return self._counts
+
+    @property
+    def tree(self):
+        """
+            The tree as a networkx DiGraph with edges from parent to child weighted by
+            -MI, built on first use so training and scoring never import networkx.
+        """
+        if self._tree is None:
+            import networkx as nx
+            self._tree = nx.DiGraph()
+            if self.parents is not None:
+                self._tree.add_nodes_from(self.variables)
+                for child in self.order[1:]:
+                    parent = self.parents[child]
+                    self._tree.add_edge(str(parent), str(child), weight = -1 * self.mutual_information(parent, child))
+        return self._tree
+
+    @property
+    def variables(self):
+        """
+            Names of the variables ('0', '1', ...).
+        """
+        n = len(self.vocab) if self.vocab is not None else len(self.counts.arities)
+        return [str(var) for var in range(n)]
 
     def probability_distribution(self, var):
         """
@@ -27,18 +99,23 @@ class Chow_Liu_Tree:
             var: the variable to be analyzed.
             return: a vector with the probability of each possible value.
         """
-        # get a list of all the possible values for the given variable
-        values = [val for _, vals in self.X.items() for val in vals]
-        distribution = []
-        for value in set(values):
-            # calculate the marginals
-            mp = self.marginal_probability(var, value)
-            #print("for", var, "=", value, "prob:", mp)
-            # ignore impossible values for var
-            if mp != 0:
-                distribution.append(mp)
-        return np.array(distribution)
+        distribution = self.distributions()[int(var)]
+        # ignore impossible values for var
+        return distribution[distribution != 0]
 
+    @profiled('distributions')
+    def distributions(self):
+        """
+            Marginal distribution of every variable over its whole vocabulary, computed
+            once and reused until the counts change.
+            return: list with a probability vector per variable (indexed like counts.vocab).
+        """
+        counts = self.counts
+        if self._distributions is None or self._distributions[0] != (id(counts), counts.version):
+            self._distributions = ((id(counts), counts.version), [marginal / counts.total for marginal in counts.marginals])
+        return self._distributions[1]
+
+    @profiled('conditional_probability')
     def conditional_probability(self, var, par, val_var, val_par):
         """
             Calculate a conditional probability.
@@ -58,53 +135,332 @@ class Chow_Liu_Tree:
             Calculate mutual information between variables.
             return: list with MI values in the fully conneted graph.
         """
-        m_info_list = [] 
-        for var1 in range(len(self.X)):
-            for var2 in range(var1):
-                m_info_list.append((str(var2), str(var1), self.mutual_information(str(var2), str(var1))))
-        return m_info_list
+        self.compute_mutual_information()
+        var1s, var2s = np.tril_indices(len(self.mi_matrix), -1)
+        return [(str(var2), str(var1), mi) for var1, var2, mi in zip(var1s, var2s, self.mi_vec)]
+
+    @profiled('mutual_information')
+    def compute_mutual_information(self, n_jobs=1):
+        """
+            Compute the MI matrix and vector between all variables from the counts.
+            n_jobs: number of worker processes sharing the work; only used when the counts are
+                not dense (above max_dense indicators), dense counts give the MI directly.
+            return: n x n matrix of mutual information values.
+        """
+        self.mi_matrix = self.counts.mutual_information(n_jobs)
+        # keep the (var1, var2) order of the pairwise loop: (1, 0), (2, 0), (2, 1), ...
+        self.mi_vec = self.mi_matrix[np.tril_indices(len(self.mi_matrix), -1)]
+        return self.mi_matrix
 
-    def build_clt(self):
+    def build_clt(self, n_jobs=1):
         """
             Build a Chow-Liu Tree from data.
-            return: tree structure.
-        """
-        m_info_list = self.calculate_mutual_information() # get the list of MI between all variables
-        m_info_list.sort(key=lambda tup : tup[2], reverse=True) # sort mutual information list in descending order
-        inserted_nodes = [] # keep track of the nodes already inserted as to not duplicate paths
-        for tup in m_info_list:
-            # if some node has not been inserted (the path between those nodes does not exist)
-            if not (tup[0] in inserted_nodes and tup[1] in inserted_nodes):
-                # build the path
-                self.tree.add_node(tup[0])
-                self.tree.add_node(tup[1])
-                # avoid more than one parent by controlling the direction of the edges through the order of assignments
-                parent, child = self.choose_parent(tup)
-                self.tree.add_edge(parent, child, weight = -1 * tup[2])
-                # register both nodes 
-                inserted_nodes.append(tup[0])
-                inserted_nodes.append(tup[1])
-        return self.tree
-
-    def choose_parent(self, tup):
-        """
-            Chooses between two connected variables which will become the parent on the CTL.
-            tup: is a tuple with the two variables to analyze.
-            return: parent and child. 
-        """
-        if len(self.tree.predecessors(tup[1])) != 0: # if the second node has already a parent
-            # then it becomes a parent
-            return tup[1], tup[0]
-        else: # otherwise the first node is assigned as the parent
-            return tup[0], tup[1]
-
-    def plot(self):
-        """
-            Plot the CLT and wait.
+            n_jobs: number of worker processes for the blocked mutual information of counts
+                that are not dense (above max_dense indicators); ignored otherwise.
+            return: parent vector of the tree.
+        """
+        if self.sparse: # the MI matrix is left uncomputed, see compute_mutual_information
+            counts = self.counts
+            self.mi_matrix, self.mi_vec = None, np.array([])
+            return self.connect(sparse_spanning_tree(counts.codes, counts.arities, counts.weights))
+        self.compute_mutual_information(n_jobs) # get the MI between all variables
+        return self.build_tree()
+
+    @profiled('tree')
+    def build_tree(self):
+        """
+            Connect the variables through the maximum spanning tree of their mutual information.
+            return: parent vector of the tree (-1 for the root), see self.tree for the graph.
+        """
+        return self.connect(maximum_spanning_tree(self.mi_matrix))
+
+    def connect(self, edges):
+        """
+            Use the given edges as the tree: orient them away from the root and fit the CPTs.
+            edges: list with the n - 1 (u, v) edges of a spanning tree.
+            return: parent vector of the tree.
+        """
+        self.parents, self.order = orient_tree(edges, len(self.counts.arities), self.root)
+        self._tree = None
+        self.counts.pin([(self.parents[child], child) for child in self.order[1:]])
+        self.compute_cpts()
+        return self.parents
+
+    @profiled('cpts')
+    def compute_cpts(self):
+        """
+            Materialize the conditional probability tables of the tree from the counts.
+            return: list with the marginal of the root and, for every other variable,
+                an arity(parent) x arity(child) table of p(child | parent).
+        """
+        counts, alpha = self.counts, self.alpha
+        self.cpts = [None] * len(self.parents)
+        self.cpts[self.root] = (counts.marginals[self.root] + alpha) / (counts.total + alpha * counts.arities[self.root])
+        for child in self.order[1:]:
+            parent = self.parents[child]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                cpt = (counts.pair_table(parent, child) + alpha) / (counts.marginals[parent][:, None] + alpha * counts.arities[child])
+            cpt[counts.marginals[parent] + alpha == 0] = 0 # parent values without data stay impossible
+            self.cpts[child] = cpt
+        self.vocab = list(counts.vocab)
+        return self.cpts
+
+    def log_likelihood(self, codes):
+        """
+            Evaluate the tree factorization for a batch of data points.
+            codes: m x n matrix with the codes of the data points (-1 for unknown values).
+            return: vector with the natural log probability of every data point.
+        """
+        codes = np.asarray(codes)
+        unknown = None
+        if np.issubdtype(codes.dtype, np.signedinteger):
+            unknown = (codes < 0).any(axis=1)
+            codes = np.where(codes < 0, 0, codes)
+        likelihood = tree_log_likelihood(self.parents, self.order, self.log_cpts(), codes)
+        if unknown is not None:
+            likelihood[unknown] = -np.inf # values never seen in training have probability 0
+        return likelihood
+
+    def log_cpts(self):
+        """
+            Natural logarithm of the CPTs, computed once per set of CPTs.
+        """
+        if self._log_cpts is None or self._log_cpts[0] is not self.cpts:
+            with np.errstate(divide='ignore'):
+                self._log_cpts = (self.cpts, [np.log(cpt) for cpt in self.cpts])
+        return self._log_cpts[1]
+
+    @profiled('score')
+    def score(self, dataset, chunk_rows=65536):
+        """
+            Evaluate the log likelihood of every data point of a data set.
+            dataset: a Dataset or a dictionary of value lists keyed by '0', '1', ...
+            chunk_rows: number of data points translated and scored at a time.
+            return: vector with the natural log probability of every data point.
+        """
+        dataset = as_dataset(dataset)
+        chunks = [self.log_likelihood(recode(dataset, self.vocab, slice(start, start + chunk_rows)))
+                  for start in range(0, len(dataset), chunk_rows)]
+        return np.concatenate(chunks) if chunks else np.array([])
+
+    def save(self, path):
+        """
+            Write the trained tree (parents, CPTs, log CPTs, vocabularies and MI matrix) to a
+            binary file whose arrays load() memory-maps in place.
+            path: destination file.
+        """
+        mi_matrix = self.mi_matrix if self.mi_matrix is not None else np.zeros((0, 0)) # not computed by sparse training
+        arrays = [('parents', np.asarray(self.parents)), ('order', np.asarray(self.order)), ('mi_matrix', mi_matrix)]
+        arrays += [('cpt.%d' % var, cpt) for var, cpt in enumerate(self.cpts)]
+        arrays += [('log_cpt.%d' % var, cpt) for var, cpt in enumerate(self.log_cpts())]
+        with open(path, 'wb') as f:
+            write_arrays(f, MODEL_MAGIC, {'root': self.root, 'vocab': [values.tolist() for values in self.vocab]}, arrays)
+
+    @classmethod
+    def from_counts(cls, counts, root='0', alpha=0.0):
+        """
+            Make an untrained tree over an existing count store (e.g. the counts of one class).
+            counts: Count_Store with the statistics to learn from.
+            root and alpha: see __init__.
+            return: Chow_Liu_Tree ready for build_clt.
+        """
+        clt = cls(root=root, alpha=alpha)
+        clt._counts = counts
+        return clt
+
+    @classmethod
+    def load(cls, path):
+        """
+            Open a tree written by save. Its arrays are read-only memory maps, so processes
+            loading the same file share one copy; the tree has no counts and cannot be updated.
+            path: file written by save.
+            return: Chow_Liu_Tree ready for scoring and queries.
+        """
+        header, arrays = read_arrays(path, MODEL_MAGIC)
+        clt = cls(root=header['root'])
+        clt.parents, clt.order = arrays['parents'], arrays['order']
+        if arrays['mi_matrix'].size:
+            clt.mi_matrix = arrays['mi_matrix']
+            clt.mi_vec = clt.mi_matrix[np.tril_indices(len(clt.mi_matrix), -1)]
+        clt.vocab = [np.array(values) for values in header['vocab']]
+        clt.cpts = [arrays['cpt.%d' % var] for var in range(len(clt.vocab))]
+        clt._log_cpts = (clt.cpts, [arrays['log_cpt.%d' % var] for var in range(len(clt.vocab))])
+        return clt
+
+    def sample_chunks(self, n_rows, seed=None, chunk_rows=1 << 20):
+        """
+            Draw data points from the tree by ancestral sampling, one chunk at a time. Every
+            variable is drawn for the whole chunk at once, in topological order: the cumulative
+            CPT rows are laid end to end (row r shifted by r) so a single searchsorted of
+            uniform draws shifted by the parent codes picks every value.
+            n_rows: number of data points.
+            seed: seed or numpy random generator.
+            chunk_rows: number of data points drawn at a time.
+            return: generator of m x n code matrices (indexed like self.vocab).
+        """
+        rng = np.random.default_rng(seed)
+        arities = [len(values) for values in self.vocab]
+        cumulative = cumulative_cpts(self.cpts)
+        for start in range(0, n_rows, chunk_rows):
+            size = min(chunk_rows, n_rows - start)
+            yield ancestral_sample(self.parents, self.order, cumulative, arities, size, rng, code_dtype(arities))
+
+    def sample(self, n_rows, seed=None, chunk_rows=1 << 20, path=None):
+        """
+            Draw a synthetic data set from the learned distribution (see sample_chunks).
+            n_rows: number of data points.
+            seed: seed or numpy random generator.
+            chunk_rows: number of data points drawn at a time.
+            path: if given, the chunks are streamed to this binary data file instead of memory.
+            return: Dataset with the sampled codes and the vocabularies of the tree
+                (memory-mapped from path when given).
+        """
+        if path is None:
+            codes = np.empty((n_rows, len(self.vocab)), dtype=code_dtype([len(values) for values in self.vocab]))
+            for start, chunk in zip(range(0, n_rows, chunk_rows), self.sample_chunks(n_rows, seed, chunk_rows)):
+                codes[start:start + len(chunk)] = chunk
+            return Dataset(codes, self.vocab)
+        with open(path, 'wb') as f:
+            dtype = code_dtype([len(values) for values in self.vocab])
+            write_header(f, MAGIC, {'shape': [n_rows, len(self.vocab)], 'dtype': dtype.str,
+                                    'vocab': [values.tolist() for values in self.vocab], 'names': self.variables})
+            for codes in self.sample_chunks(n_rows, seed, chunk_rows):
+                f.write(codes.tobytes())
+        return load_binary(path)
+
+    def inference(self):
+        """
+            Message passing engine over the current CPTs, kept between queries.
+        """
+        if self._inference is None or self._inference.cpts is not self.cpts:
+            self._inference = Belief_Propagation(self.parents, self.order, self.cpts)
+        return self._inference
+
+    def evidence_codes(self, evidence):
+        """
+            Translate evidence values into a batch of evidence codes.
+            evidence: dictionary from variable to a value or to a list of values (one per query).
+            return: B x n matrix of codes (-1 where not observed, arity for unknown values)
+                and whether the evidence was given as a batch.
+        """
+        batched = any(np.ndim(values) > 0 for values in evidence.values())
+        size = max([len(values) for values in evidence.values() if np.ndim(values) > 0] or [1])
+        codes = np.full((size, len(self.parents)), -1, dtype=np.intp)
+        for var, values in evidence.items():
+            var = int(var)
+            index = dict((value, code) for code, value in enumerate(self.vocab[var].tolist()))
+            values = np.atleast_1d(values).tolist()
+            codes[:, var] = [index.get(value, len(index)) for value in values]
+        return codes, batched
+
+    @profiled('inference')
+    def query(self, targets=None, evidence=None, kind="marginal"):
+        """
+            Answer marginal or MAP queries under evidence by message passing over the tree.
+            targets: variables to query, all of them by default.
+            evidence: dictionary from variable to an observed value, or to a list of values
+                to run one query per position as a single batch.
+            kind: "marginal" for posterior distributions (indexed like self.vocab) or
+                "map" for the values of the most probable joint assignment.
+            return: dictionary from target to its posterior (or MAP value), with a leading
+                batch axis when the evidence is a batch.
         """
+        targets = self.variables if targets is None else targets
+        codes, batched = self.evidence_codes(evidence or {})
+        indices = [int(target) for target in targets]
+        if kind == "map":
+            results = self.inference().map(codes, indices)
+            results = dict((var, self.vocab[var][code]) for var, code in results.items())
+        else:
+            results = self.inference().marginals(codes, indices)
+        return dict((str(var), result if batched else result[0]) for var, result in results.items())
+
+    def online_counts(self):
+        """
+            Count store for online updates, which change every pairwise table.
+        """
+        if self.sparse:
+            raise ValueError("a sparse tree only keeps the pairwise counts of its edges and cannot "
+                             "learn online; train it again instead")
+        counts = self.counts
+        if counts.pairs is None:
+            raise ValueError("online updates need every pairwise count: build the tree with "
+                             "max_dense >= %d (the number of indicators)" % np.sum(counts.arities))
+        return counts
+
+    def update(self, rows):
+        """
+            Learn from new data points without rebuilding the tree from scratch. Online
+            updates need dense counts (see max_dense) and are not available to sparse trees.
+            rows: list of data points, each one a list with a value per variable.
+            return: parent vector of the tree.
+        """
+        counts = self.online_counts()
+        counts.add(counts.encode_rows(rows))
+        return self.refresh()
+
+    def evict(self, rows):
+        """
+            Forget data points the tree has learned from (dense counts only, see update).
+            rows: list of data points, each one a list with a value per variable.
+            return: parent vector of the tree.
+        """
+        counts = self.online_counts()
+        counts.remove(counts.encode_rows(rows, grow=False))
+        return self.refresh()
+
+    def replace(self, row, var, value):
+        """
+            Change one cell of the data and update the tree with a delta of the counts
+            (dense counts only, see update).
+            row: index of the data point.
+            var: the variable of the cell.
+            value: the new value of the cell.
+            return: parent vector of the tree.
+        """
+        var = int(var)
+        counts = self.online_counts()
+        code = counts.code(var, value)
+        if code < 0:
+            raise ValueError("variable %d never took the value %r" % (var, value))
+        counts.replace_cell(row, var, code)
+        return self.refresh([var])
+
+    @profiled('refresh')
+    def refresh(self, variables=None):
+        """
+            Recompute the mutual information from the counts and repair the tree
+            only if the order of the edge weights changed.
+            variables: if given, only the MI involving these variables has changed.
+            return: parent vector of the tree.
+        """
+        previous = np.argsort(self.mi_vec, kind='stable')
+        if variables is None or self.mi_matrix is None:
+            self.compute_mutual_information()
+        else:
+            rows = self.counts.mutual_information_rows(variables)
+            self.mi_matrix[variables, :] = rows
+            self.mi_matrix[:, variables] = rows.T
+            self.mi_vec = self.mi_matrix[np.tril_indices(len(self.mi_matrix), -1)]
+        if len(previous) != len(self.mi_vec) or not np.array_equal(previous, np.argsort(self.mi_vec, kind='stable')):
+            return self.build_tree()
+        self._tree = None # same edges, new weights
+        self.compute_cpts()
+        return self.parents
+
+    def plot(self, path='tree.png'):
+        """
+            Draw the CLT into an image file; the figure is saved and closed, never shown.
+            path: destination image, its extension picks the format.
+            return: path of the image.
+        """
+        import matplotlib.pyplot as plt
+        import networkx as nx
+        plt.figure()
         nx.draw(self.tree, with_labels=True)
-        plt.draw()
-        plt.waitforbuttonpress()
+        plt.savefig(path)
+        plt.close()
+        return path
 
     def mutual_information(self, var1, var2):
         """
@@ -112,20 +468,11 @@ class Chow_Liu_Tree:
             var1 and var2: random variables to anaylze.
             return: mutual information between var1 and var2.
         """
-        mutual_info = 0 # information cummulative value
-        compared_vals = [] # list for filtering repeated comparisons
-        for x_i in self.X[var1]: # go through all values of the first and second variable
-            for x_j in self.X[var2]:
-                if not ((x_i, x_j) in compared_vals): # avoid already compared values
-                    jp = self.joint_probability(var1, var2, x_i, x_j)
-                    mp_v1 = self.marginal_probability(var1, x_i)
-                    mp_v2 = self.marginal_probability(var2, x_j)
-                    # jp != 0 for filtering only values that belong to the distribution
-                    mutual_info += 1.0 * jp * np.log2(1.0 * jp / (mp_v1 * mp_v2)) if (jp != 0) else 0
-                    compared_vals.append((x_i, x_j))
-        self.mi_vec = np.append(self.mi_vec, mutual_info)
-        return mutual_info
+        if self.mi_matrix is not None:
+            return self.mi_matrix[int(var1), int(var2)]
+        return table_mutual_information(self.counts.pair_table(int(var1), int(var2)), self.counts.total)
 
+    @profiled('marginal_probability')
     def marginal_probability(self, var, x):
         """
             Compute the marginal of a variable for a specific value.
@@ -133,8 +480,9 @@ class Chow_Liu_Tree:
             x: specific probable value.
             return: probability of var having value x.
         """
-        return 1.0 * self.X[var].count(x) / len(self.X[var])
+        return self.counts.marginal_probability(int(var), x)
 
+    @profiled('joint_probability')
     def joint_probability(self, var1, var2, x_i, x_j):
         """
             Compute the joint probability of two variables given one possible value for each variable.
@@ -145,12 +493,4 @@ class Chow_Liu_Tree:
             x_j: value for the second variable.
             return: joint probability of var1 and var2 for values x_i and x_j. 
         """
-        var1_events = self.X[var1] # event list from data for variable 1
-        var2_events = self.X[var2] # event list from data for variable 2
-        appearances = 0 # counter for the occurances of a particular combination event list data
-        combination = (x_i, x_j) # set the combination with the values given
-        for tup in zip(var1_events, var2_events): # go through the event list of both variables
-            if tup == combination: # if the specified combination is found then increment the counter
-                appearances += 1
-        return 1.0 * appearances / len(self.X[var1]) # return the probability of that joint event
-
+        return self.counts.joint_probability(int(var1), int(var2), x_i, x_j)
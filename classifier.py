@@ -0,0 +1,154 @@
+"""
+Chow-Liu tree classifier: one tree per class label, all counted in one pass over the data
+and all scored together.
+
+    classifier = Chow_Liu_Classifier(alpha=1.0).fit(features, labels)
+    probabilities = classifier.predict_proba(test)
+"""
+import numpy as np
+from chow_liu_tree import Chow_Liu_Tree
+from counts import Count_Store, class_pair_counts
+from dataset import Dataset, as_dataset, recode
+from profiling import profiled
+
+def split_labels(dataset, var):
+    """
+        Separate the label column from the features of a data set.
+        dataset: a Dataset or a dictionary of value lists keyed by '0', '1', ...
+        var: index of the label variable.
+        return: Dataset with the other variables and the vector of label values.
+    """
+    dataset = as_dataset(dataset)
+    keep = [other for other in range(dataset.n_vars) if other != var]
+    labels = dataset.vocab[var][dataset.codes[:, var]]
+    features = Dataset(dataset.codes[:, keep], [dataset.vocab[other] for other in keep],
+                       [dataset.names[other] for other in keep], dataset.weights)
+    return features, labels
+
+class Chow_Liu_Classifier:
+    def __init__(self, alpha=1.0, root='0', max_dense=2048):
+        """
+            Initialization function
+            alpha: Laplace smoothing of the class priors and of the CPTs of every class tree.
+            root: variable the edges of every class tree point away from.
+            max_dense: largest number of (variable, value) indicators for which the pairwise
+                counts of all classes are gathered in one pass; wider data trains every
+                class tree on its own rows instead.
+        """
+        self.alpha = alpha
+        self.root = root
+        self.max_dense = max_dense
+        self.classes = None # label value of every class
+        self.trees = None # Chow_Liu_Tree of every class
+        self.log_priors = None
+        self.vocab = None # values behind the codes shared by every class tree
+        self._tables = None # stacked log CPTs of all the trees, see stack_tables
+
+    @profiled('classifier.fit')
+    def fit(self, X, labels, n_jobs=1):
+        """
+            Learn one tree per class. The pairwise counts of all classes come from a single
+            pass over the data, as a classes x indicators x indicators array.
+            X: features, a Dataset or a dictionary of value lists keyed by '0', '1', ...
+            labels: label value of every data point.
+            n_jobs: number of worker processes for the mutual information of wide data.
+            return: self.
+        """
+        data = as_dataset(X)
+        self.classes, y = np.unique(np.asarray(labels), return_inverse=True)
+        y = y.ravel()
+        if len(y) != len(data):
+            raise ValueError("there must be one label per data point")
+        weights = data.weights
+        totals = np.bincount(y, weights=weights, minlength=len(self.classes))
+        self.log_priors = np.log((totals + self.alpha) / (np.sum(totals) + self.alpha * len(self.classes)))
+        if np.sum(data.arities) <= self.max_dense:
+            pairs = class_pair_counts(data.codes, data.arities, y, len(self.classes), weights=weights)
+            stores = [Count_Store.from_pairs(pairs[c], data.vocab) for c in range(len(self.classes))]
+        else:
+            stores = [Count_Store.from_dataset(data.take(y == c), max_dense=0) for c in range(len(self.classes))]
+        self.trees = []
+        for store in stores:
+            clt = Chow_Liu_Tree.from_counts(store, root=self.root, alpha=self.alpha)
+            clt.build_clt(n_jobs)
+            self.trees.append(clt)
+        self.vocab = list(data.vocab)
+        self._tables = None
+        return self
+
+    def stack_tables(self):
+        """
+            Lay the log CPTs of every class tree end to end in one vector, so a single gather
+            evaluates all the trees: the entry of (class c, variable v, parent code p, code x)
+            is at offsets[c, v] + p * arity(v) + x, the root using p = 0.
+            return: the vector, the offsets (classes x n) and the parents (classes x n, the
+                root pointing to the extra all-zero column n of the codes).
+        """
+        if self._tables is None:
+            n = len(self.vocab)
+            offsets = np.zeros((len(self.trees), n), dtype=np.intp)
+            parents = np.zeros((len(self.trees), n), dtype=np.intp)
+            tables, size = [], 0
+            for c, clt in enumerate(self.trees):
+                for var, log_cpt in enumerate(clt.log_cpts()):
+                    offsets[c, var] = size
+                    tables.append(np.ravel(log_cpt))
+                    size += log_cpt.size
+                parents[c] = np.where(clt.parents < 0, n, clt.parents)
+            tables = np.concatenate(tables)
+            # small indices keep the m x classes x n gather in cache
+            dtype = np.int32 if size < 2 ** 31 else np.intp
+            self._tables = (tables, offsets.astype(dtype), parents)
+        return self._tables
+
+    def log_likelihood(self, codes):
+        """
+            Evaluate every class tree on a batch of data points at once.
+            codes: m x n matrix with the codes of the data points (-1 for unknown values).
+            return: m x classes matrix with the natural log probability of every data point
+                under every class tree.
+        """
+        tables, offsets, parents = self.stack_tables()
+        codes = np.asarray(codes)
+        unknown = (codes < 0).any(axis=1)
+        padded = np.zeros((codes.shape[0], codes.shape[1] + 1), dtype=offsets.dtype)
+        padded[:, :-1] = np.maximum(codes, 0)
+        arities = np.array([len(values) for values in self.vocab], dtype=offsets.dtype)
+        index = padded[:, parents] * arities # parent codes, m x classes x n
+        index += offsets
+        index += padded[:, None, :-1]
+        likelihood = tables[index].sum(axis=2)
+        likelihood[unknown] = -np.inf # values never seen in training have probability 0
+        return likelihood
+
+    @profiled('classifier.predict')
+    def predict_log_proba(self, X, chunk_rows=8192):
+        """
+            Log posterior of every class for every data point.
+            X: data set to classify, with the variables of the training features.
+            chunk_rows: number of data points translated and scored at a time.
+            return: m x classes matrix; data points that no class can explain (e.g. values
+                never seen in training) get the class priors.
+        """
+        dataset = as_dataset(X)
+        chunks = []
+        for start in range(0, len(dataset), chunk_rows):
+            joint = self.log_likelihood(recode(dataset, self.vocab, slice(start, start + chunk_rows))) + self.log_priors
+            joint[np.isneginf(joint).all(axis=1)] = self.log_priors
+            top = np.max(joint, axis=1, keepdims=True)
+            chunks.append(joint - (top + np.log(np.sum(np.exp(joint - top), axis=1, keepdims=True))))
+        return np.concatenate(chunks) if chunks else np.zeros((0, len(self.classes)))
+
+    def predict_proba(self, X, chunk_rows=8192):
+        """
+            Posterior probability of every class for every data point.
+            return: m x classes matrix, columns in the order of self.classes.
+        """
+        return np.exp(self.predict_log_proba(X, chunk_rows))
+
+    def predict(self, X, chunk_rows=8192):
+        """
+            Most probable class of every data point.
+            return: vector of label values.
+        """
+        return self.classes[np.argmax(self.predict_log_proba(X, chunk_rows), axis=1)]
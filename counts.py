@@ -0,0 +1,536 @@
+"""
+Sufficient statistics (counts and mutual information) for Chow-Liu trees.
+"""
+import numpy as np
+from collections import OrderedDict, deque
+from multiprocessing import Pool, shared_memory
+from dataset import Dataset
+
+CHUNK_CELLS = 1 << 23 # indicator entries expanded at a time, whatever the width of the data
+BLOCK_COLUMNS = 2048 # largest number of indicator columns of a block of variables
+
+def value_offsets(arities):
+    """
+        Compute where each variable starts in the concatenated (variable, value) axis.
+        arities: number of values of each variable.
+        return: vector with the offset of each variable.
+    """
+    return np.concatenate(([0], np.cumsum(arities)[:-1])).astype(np.intp)
+
+def one_hot(codes, arities, dtype=float):
+    """
+        Expand a code matrix into indicator columns, one per (variable, value).
+        codes: N x n matrix of codes.
+        arities: number of values of each variable.
+        dtype: type of the indicators.
+        return: N x sum(arities) indicator matrix.
+    """
+    indicators = np.zeros((codes.shape[0], int(np.sum(arities))), dtype=dtype)
+    indicators[np.arange(codes.shape[0])[:, None], codes + value_offsets(arities)] = 1
+    return indicators
+
+def indicator_chunks(columns, weights=None, chunk_rows=None):
+    """
+        Size the chunks of data points expanded to indicators.
+        columns: number of indicator columns expanded per data point.
+        weights: optional weight of every data point.
+        chunk_rows: number of data points per chunk, by default about CHUNK_CELLS entries.
+        return: number of data points per chunk and the type of the indicators; unweighted
+            chunks use float32, whose per-chunk counts (at most 16384) are exact.
+    """
+    if chunk_rows is None:
+        chunk_rows = max(1, min(16384, CHUNK_CELLS // max(columns, 1)))
+    return chunk_rows, (np.float32 if weights is None and chunk_rows < 1 << 24 else float)
+
+def pair_counts(codes, arities, vars1=slice(None), vars2=slice(None), chunk_rows=None, weights=None):
+    """
+        Count every pairwise combination of values between two groups of variables.
+        codes: N x n matrix of codes.
+        arities: number of values of each variable.
+        vars1 and vars2: slices selecting the two groups of variables.
+        chunk_rows: number of data points expanded to indicators at a time (see indicator_chunks).
+        weights: optional weight of every data point.
+        return: matrix holding the contingency table of every (var1, var2) pair.
+    """
+    arities1, arities2 = arities[vars1], arities[vars2]
+    counts = np.zeros((int(np.sum(arities1)), int(np.sum(arities2))))
+    chunk_rows, dtype = indicator_chunks(len(counts) + counts.shape[1], weights, chunk_rows)
+    for start in range(0, codes.shape[0], chunk_rows):
+        chunk = codes[start:start + chunk_rows]
+        indicators1 = one_hot(chunk[:, vars1], arities1, dtype)
+        if weights is not None:
+            indicators1 *= weights[start:start + chunk_rows, None]
+        counts += indicators1.T.dot(one_hot(chunk[:, vars2], arities2, dtype))
+    return counts
+
+def class_pair_counts(codes, arities, labels, n_classes, chunk_rows=None, weights=None):
+    """
+        Count every pairwise combination of values separately for every class, in a single
+        pass over the data.
+        codes: N x n matrix of codes.
+        arities: number of values of each variable.
+        labels: class index (0 .. n_classes - 1) of every data point.
+        n_classes: number of classes.
+        chunk_rows: number of data points expanded to indicators at a time (see indicator_chunks).
+        weights: optional weight of every data point.
+        return: n_classes x sum(arities) x sum(arities) array; entry c holds the pairwise
+            tables (and marginals on the diagonal) of the data points of class c.
+    """
+    size = int(np.sum(arities))
+    counts = np.zeros((n_classes, size, size))
+    chunk_rows, dtype = indicator_chunks(size, weights, chunk_rows)
+    for start in range(0, codes.shape[0], chunk_rows):
+        indicators = one_hot(codes[start:start + chunk_rows], arities, dtype)
+        chunk_labels = labels[start:start + chunk_rows]
+        weighted = indicators if weights is None else indicators * weights[start:start + chunk_rows, None]
+        # group the chunk by class so every class is a contiguous block of rows
+        order = np.argsort(chunk_labels, kind='stable')
+        bounds = np.searchsorted(chunk_labels[order], np.arange(n_classes + 1))
+        for c in range(n_classes):
+            rows = order[bounds[c]:bounds[c + 1]]
+            if len(rows):
+                counts[c] += indicators[rows].T.dot(weighted[rows])
+    return counts
+
+def marginal_counts(codes, arities, vars=slice(None), chunk_rows=16384, weights=None):
+    """
+        Count the values of a group of variables.
+        codes: N x n matrix of codes.
+        arities: number of values of each variable.
+        vars: slice selecting the variables.
+        chunk_rows: number of data points read at a time.
+        weights: optional weight of every data point.
+        return: vector with the count of every (variable, value) of the group.
+    """
+    arities = arities[vars]
+    offsets = value_offsets(arities)
+    counts = np.zeros(int(np.sum(arities)))
+    for start in range(0, codes.shape[0], chunk_rows):
+        cells = codes[start:start + chunk_rows, vars] + offsets
+        if weights is None:
+            counts += np.bincount(cells.ravel(), minlength=len(counts))
+        else: # every cell of a data point carries the weight of the point
+            cell_weights = np.repeat(weights[start:start + chunk_rows], cells.shape[1])
+            counts += np.bincount(cells.ravel(), weights=cell_weights, minlength=len(counts))
+    return counts
+
+def block_mutual_information(counts, total, marginals1, marginals2, arities1, arities2):
+    """
+        Compute the mutual information between two groups of variables from their pairwise counts.
+        counts: matrix holding the contingency table of every (var1, var2) pair.
+        total: number of data points the counts were taken from.
+        marginals1 and marginals2: marginal counts of every (variable, value) of each group.
+        arities1 and arities2: number of values of each variable of each group.
+        return: matrix of mutual information values (in bits).
+    """
+    joint = counts / total
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = np.where(joint > 0, joint * np.log2(joint / np.outer(marginals1 / total, marginals2 / total)), 0)
+    # add up every contingency table block into a single cell
+    return np.add.reduceat(np.add.reduceat(terms, value_offsets(arities1), axis=0), value_offsets(arities2), axis=1)
+
+def mutual_information_from_counts(counts, total, arities):
+    """
+        Compute the mutual information between all variables from their pairwise counts.
+        counts: sum(arities) x sum(arities) matrix holding every pairwise contingency table.
+        total: number of data points the counts were taken from.
+        arities: number of values of each variable.
+        return: n x n matrix of mutual information values (in bits).
+    """
+    marginals = np.diag(counts) # the diagonal blocks hold the marginal counts
+    mi = np.triu(block_mutual_information(counts, total, marginals, marginals, arities, arities), 1)
+    return mi + mi.T # mirror the var1 < var2 values so the matrix is exactly symmetric
+
+_shared = {} # code matrix attached by each worker process
+
+def _attach_codes(name, shape, dtype, arities, weights=None):
+    """
+        Pool initializer: map the shared code matrix into the worker process.
+    """
+    memory = shared_memory.SharedMemory(name=name)
+    _shared['memory'] = memory # keep the mapping alive
+    _shared['codes'] = np.ndarray(shape, dtype=dtype, buffer=memory.buf)
+    _shared['arities'] = arities
+    _shared['weights'] = weights
+
+def _mutual_information_task(task, codes=None, arities=None, weights=None):
+    """
+        Compute the mutual information block between two groups of variables.
+        task: pair of (start, stop) variable ranges.
+        codes, arities and weights: data to use, the shared ones when not given.
+        return: the task and its block of mutual information values.
+    """
+    if codes is None:
+        codes, arities, weights = _shared['codes'], _shared['arities'], _shared['weights']
+    vars1, vars2 = slice(*task[0]), slice(*task[1])
+    counts = pair_counts(codes, arities, vars1, vars2, weights=weights)
+    marginals1 = marginal_counts(codes, arities, vars1, weights=weights)
+    marginals2 = marginal_counts(codes, arities, vars2, weights=weights)
+    total = codes.shape[0] if weights is None else np.sum(weights)
+    return task, block_mutual_information(counts, total, marginals1, marginals2, arities[vars1], arities[vars2])
+
+def variable_blocks(arities, block_size):
+    """
+        Split the variables into consecutive ranges with at most block_size indicator columns.
+        arities: number of values of each variable.
+        block_size: largest number of indicator columns per range.
+        return: list of (start, stop) variable ranges.
+    """
+    ranges, start, columns = [], 0, 0
+    for var, arity in enumerate(arities.tolist()):
+        if var > start and columns + arity > block_size:
+            ranges.append((start, var))
+            start, columns = var, 0
+        columns += arity
+    if start < len(arities):
+        ranges.append((start, len(arities)))
+    return ranges
+
+def mutual_information_matrix(codes, arities, n_jobs=1, block_size=None, weights=None):
+    """
+        Compute the mutual information between all pairs of variables, one block of
+        variable pairs at a time, optionally spreading the blocks over a process pool.
+        codes: N x n matrix of codes.
+        arities: number of values of each variable.
+        n_jobs: number of worker processes.
+        block_size: largest number of indicator columns (values of the variables) per
+            block; by default enough blocks to keep every worker busy, and at most
+            BLOCK_COLUMNS. A variable wider than the block gets a block of its own.
+        weights: optional weight of every data point.
+        return: n x n matrix of mutual information values (in bits).
+    """
+    n = codes.shape[1]
+    arities = np.asarray(arities, dtype=np.intp)
+    if block_size is None:
+        columns = int(np.sum(arities))
+        block_size = min(BLOCK_COLUMNS, int(np.ceil(1.0 * columns / np.ceil(np.sqrt(8 * n_jobs))))) if n_jobs > 1 else BLOCK_COLUMNS
+    ranges = variable_blocks(arities, block_size)
+    tasks = [(range1, range2) for i, range1 in enumerate(ranges) for range2 in ranges[i:]]
+    mi = np.zeros((n, n))
+    if n_jobs > 1 and len(tasks) > 1:
+        # share the code matrix once instead of pickling the data for every task
+        codes = np.ascontiguousarray(codes)
+        memory = shared_memory.SharedMemory(create=True, size=max(codes.nbytes, 1))
+        try:
+            np.ndarray(codes.shape, dtype=codes.dtype, buffer=memory.buf)[:] = codes
+            with Pool(n_jobs, initializer=_attach_codes, initargs=(memory.name, codes.shape, codes.dtype, arities, weights)) as pool:
+                results = pool.map(_mutual_information_task, tasks)
+        finally:
+            memory.close()
+            memory.unlink()
+    else:
+        results = [_mutual_information_task(task, codes, arities, weights) for task in tasks]
+    for ((start1, stop1), (start2, stop2)), block in results:
+        mi[start1:stop1, start2:stop2] = block
+    mi = np.triu(mi, 1)
+    return mi + mi.T # mirror the var1 < var2 values so the matrix is exactly symmetric
+
+def table_mutual_information(table, total):
+    """
+        Compute the mutual information held in a single contingency table.
+        table: counts of every (x_i, x_j) combination of two variables.
+        total: number of data points the counts were taken from.
+        return: mutual information between both variables (in bits).
+    """
+    joint = table / total
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = np.where(joint > 0, joint * np.log2(joint / np.outer(joint.sum(1), joint.sum(0))), 0)
+    return np.sum(terms)
+
+class Count_Store:
+    def __init__(self, codes, vocab, max_dense=2048, max_pair_tables=4096, window=None, decay=None, weights=None):
+        """
+            Initialization function
+            codes: N x n matrix of codes.
+            vocab: list with the values behind the codes of each variable.
+            max_dense: largest number of (variable, value) indicators for which all the
+                pairwise tables are precomputed; above it tables are built on demand.
+            max_pair_tables: how many on-demand pairwise tables are kept at once.
+            window: if given, only the last window data points are counted.
+            decay: if given, every new data point multiplies the previous counts by decay.
+            weights: optional weight of every data point (e.g. from Dataset.compress).
+        """
+        if window is not None and decay is not None:
+            raise ValueError("a count store can use either a sliding window or decay, not both")
+        if window is not None and weights is not None:
+            raise ValueError("a sliding window counts unweighted data points")
+        if window is not None:
+            codes = codes[-window:]
+        self.window = window
+        self.decay = decay
+        self.rows = deque(codes) if window is not None else None # data points inside the window
+        self.codes = codes
+        self.weights = None if weights is None else np.asarray(weights, dtype=float)
+        self.vocab = vocab
+        self.arities = np.array([len(values) for values in vocab], dtype=np.intp)
+        self.offsets = value_offsets(self.arities)
+        self.index = [{value: code for code, value in enumerate(values.tolist())} for values in vocab]
+        self.total = codes.shape[0] if weights is None else np.sum(self.weights)
+        self.version = 0 # bumped on every change of the counts
+        self.max_pair_tables = max_pair_tables
+        self.pairs = None # dense matrix holding every pairwise table
+        self.pair_tables = OrderedDict() # on-demand tables in least recently used order
+        self.pinned = set() # on-demand tables that must never be evicted (e.g. tree edges)
+        # counts are accumulated a chunk of data points at a time, so codes can be memory-mapped
+        if np.sum(self.arities) <= max_dense:
+            self.pairs = pair_counts(codes, self.arities, weights=self.weights)
+            counts = np.diag(self.pairs).copy()
+        else:
+            counts = marginal_counts(codes, self.arities, weights=self.weights)
+        self.marginals = np.split(counts, self.offsets[1:])
+
+    @classmethod
+    def from_dataset(cls, dataset, **kwargs):
+        """
+            Build a count store from a Dataset.
+        """
+        return cls(dataset.codes, list(dataset.vocab), weights=dataset.weights, **kwargs)
+
+    @classmethod
+    def from_pairs(cls, pairs, vocab):
+        """
+            Build a dense count store from precomputed pairwise counts (e.g. one class of
+            class_pair_counts); there is no code matrix behind it.
+            pairs: sum(arities) x sum(arities) matrix of pairwise counts.
+            vocab: list with the values behind the codes of each variable.
+        """
+        store = cls(np.zeros((0, len(vocab)), dtype=np.intp), vocab)
+        store.codes = None
+        store.pairs = pairs
+        store.marginals = np.split(np.diag(pairs).copy(), store.offsets[1:])
+        store.total = np.sum(store.marginals[0]) if len(vocab) else 0
+        return store
+
+    @classmethod
+    def from_dict(cls, X, **kwargs):
+        """
+            Build a count store from a dictionary of value lists keyed by '0', '1', ...
+        """
+        return cls.from_dataset(Dataset.from_dict(X), **kwargs)
+
+    def code(self, var, value):
+        """
+            Look up the code of a value.
+            var: index of the variable.
+            value: value of the variable.
+            return: code of the value, -1 if the variable never takes it.
+        """
+        return self.index[var].get(value, -1)
+
+    def encode_rows(self, rows, grow=True):
+        """
+            Encode data points with the store vocabularies.
+            rows: list of data points, each one a sequence with a value per variable.
+            grow: whether unseen values are added to the vocabularies or rejected.
+            return: m x n matrix of codes.
+        """
+        codes = np.empty((len(rows), len(self.vocab)), dtype=np.intp)
+        for r, row in enumerate(rows):
+            for var, value in enumerate(row):
+                code = self.code(var, value)
+                if code < 0:
+                    if not grow:
+                        raise ValueError("variable %d never took the value %r" % (var, value))
+                    code = self.grow(var, value)
+                codes[r, var] = code
+        return codes
+
+    def check_dense(self):
+        """
+            Incremental updates change the dense pairwise counts; refuse them without.
+        """
+        if self.pairs is None:
+            raise ValueError("incremental updates need dense pairwise counts: build the store with "
+                             "max_dense >= %d (the number of indicators)" % np.sum(self.arities))
+
+    def grow(self, var, value):
+        """
+            Add a new value at the end of the vocabulary of a variable.
+            var: index of the variable.
+            value: the new value.
+            return: code of the new value.
+        """
+        self.check_dense()
+        code = int(self.arities[var])
+        self.vocab[var] = np.append(self.vocab[var], value)
+        self.index[var][value] = code
+        self.marginals[var] = np.append(self.marginals[var], 0.0)
+        # open an empty row and column for the value in the dense pairwise counts
+        position = self.offsets[var] + code
+        self.pairs = np.insert(np.insert(self.pairs, position, 0.0, axis=0), position, 0.0, axis=1)
+        self.arities[var] += 1
+        self.offsets = value_offsets(self.arities)
+        self.version += 1
+        return code
+
+    def accumulate(self, codes, weights):
+        """
+            Add weighted data points to the marginal and pairwise counts.
+            codes: m x n matrix of codes.
+            weights: weight of each data point (negative to take points out).
+        """
+        for var, arity in enumerate(self.arities):
+            self.marginals[var] += np.bincount(codes[:, var], weights=weights, minlength=arity)
+        indicators = one_hot(codes, self.arities)
+        self.pairs += indicators.T.dot(indicators * weights[:, None])
+        self.total += np.sum(weights)
+        self.version += 1
+
+    def add(self, codes):
+        """
+            Add encoded data points, forgetting the ones that leave the window or decay.
+            codes: m x n matrix of codes.
+        """
+        self.check_dense()
+        weights = np.ones(len(codes))
+        if self.decay is not None:
+            # the newest point keeps weight 1, the previous counts fade by decay per point
+            weights = self.decay ** np.arange(len(codes) - 1, -1, -1, dtype=float)
+            decay = self.decay ** len(codes)
+            self.marginals = [marginal * decay for marginal in self.marginals]
+            self.pairs *= decay
+            self.total *= decay
+        self.accumulate(codes, weights)
+        self.codes = self.weights = None # the counts no longer come from a stored code matrix
+        if self.rows is not None:
+            self.rows.extend(codes)
+            expired = [self.rows.popleft() for _ in range(len(self.rows) - self.window)]
+            if expired:
+                self.accumulate(np.array(expired), -np.ones(len(expired)))
+
+    def replace_cell(self, row, var, code):
+        """
+            Change the value of one cell with a delta update of the counts (O(n) work);
+            a weighted data point moves its whole weight.
+            row: index of the data point in codes.
+            var: index of the variable.
+            code: new code of the cell.
+        """
+        self.check_dense()
+        if self.codes is None:
+            raise ValueError("cell updates need the code matrix the counts came from")
+        old = int(self.codes[row, var])
+        if old == code:
+            return
+        weight = 1 if self.weights is None else self.weights[row]
+        for value, sign in ((old, -weight), (code, weight)):
+            self.codes[row, var] = value
+            cells = self.offsets + self.codes[row] # indicator positions of the data point
+            cell = cells[var]
+            self.pairs[cell, cells] += sign
+            self.pairs[cells, cell] += sign
+            self.pairs[cell, cell] -= sign # the diagonal entry was changed twice
+            self.marginals[var][value] += sign
+        self.version += 1
+
+    def remove(self, codes):
+        """
+            Take encoded data points out of the counts; they must have been learned (and,
+            with a window, still be inside it), otherwise nothing changes and ValueError is raised.
+            codes: m x n matrix of codes.
+        """
+        self.check_dense()
+        if self.decay is not None:
+            raise ValueError("data points cannot be evicted from decayed counts")
+        kept = None
+        if self.rows is not None:
+            kept, evicted = list(self.rows), set()
+            for row in codes:
+                # the oldest copy of the point still inside the window
+                position = next((position for position, point in enumerate(kept)
+                                 if position not in evicted and np.array_equal(point, row)), None)
+                if position is None:
+                    raise ValueError("data point %r is not inside the window" % (row.tolist(),))
+                evicted.add(position)
+            kept = [point for position, point in enumerate(kept) if position not in evicted]
+        indicators = one_hot(codes, self.arities)
+        if np.any(self.pairs - indicators.T.dot(indicators) < -1e-9):
+            raise ValueError("the data points to evict were never learned (their counts would go negative)")
+        self.accumulate(codes, -np.ones(len(codes)))
+        self.codes = self.weights = None
+        if kept is not None:
+            self.rows = deque(kept)
+
+    def pair_table(self, var1, var2):
+        """
+            Get the contingency table of two variables.
+            var1 and var2: indices of the variables.
+            return: arity(var1) x arity(var2) matrix of counts.
+        """
+        if self.pairs is not None:
+            start1, start2 = self.offsets[var1], self.offsets[var2]
+            return self.pairs[start1:start1 + self.arities[var1], start2:start2 + self.arities[var2]]
+        if (var2, var1) in self.pair_tables:
+            return self.pair_table(var2, var1).T
+        table = self.pair_tables.get((var1, var2))
+        if table is None:
+            arity1, arity2 = self.arities[var1], self.arities[var2]
+            # a single pair of columns: count the combined codes directly
+            cells = self.codes[:, var1].astype(np.intp) * arity2 + self.codes[:, var2]
+            table = np.bincount(cells, weights=self.weights, minlength=arity1 * arity2).astype(float).reshape(arity1, arity2)
+            self.pair_tables[(var1, var2)] = table
+            self.evict_pair_tables()
+        else:
+            self.pair_tables.move_to_end((var1, var2))
+        return table
+
+    def pin(self, edges):
+        """
+            Keep the tables of the given pairs of variables resident (used for tree edges).
+            edges: iterable of (var1, var2) index pairs.
+        """
+        self.pinned = set((min(edge), max(edge)) for edge in edges)
+
+    def evict_pair_tables(self):
+        """
+            Drop the least recently used on-demand tables that are above the limit.
+        """
+        for key in list(self.pair_tables):
+            if len(self.pair_tables) <= self.max_pair_tables:
+                break
+            if (min(key), max(key)) not in self.pinned:
+                del self.pair_tables[key]
+
+    def marginal_probability(self, var, x):
+        """
+            Probability of variable var (index) having value x.
+        """
+        code = self.code(var, x)
+        return 0.0 if code < 0 else self.marginals[var][code] / self.total
+
+    def joint_probability(self, var1, var2, x_i, x_j):
+        """
+            Probability of variables var1 and var2 (indices) having values x_i and x_j.
+        """
+        code1, code2 = self.code(var1, x_i), self.code(var2, x_j)
+        if code1 < 0 or code2 < 0:
+            return 0.0
+        return self.pair_table(var1, var2)[code1, code2] / self.total
+
+    def mutual_information_rows(self, vars):
+        """
+            Compute the mutual information between some variables and all the others.
+            vars: indices of the variables.
+            return: len(vars) x n matrix of mutual information values (in bits).
+        """
+        if self.pairs is None:
+            return mutual_information_matrix(self.codes, self.arities, weights=self.weights)[vars]
+        marginals = np.diag(self.pairs)
+        rows = []
+        for var in vars:
+            cells = slice(self.offsets[var], self.offsets[var] + self.arities[var])
+            row = block_mutual_information(self.pairs[cells], self.total, marginals[cells], marginals,
+                                           self.arities[var:var + 1], self.arities)[0]
+            row[var] = 0
+            rows.append(row)
+        return np.array(rows)
+
+    def mutual_information(self, n_jobs=1):
+        """
+            Compute the mutual information between all pairs of variables.
+            n_jobs: number of worker processes used when the pairwise counts are not dense.
+            return: n x n matrix of mutual information values (in bits).
+        """
+        if self.pairs is not None:
+            return mutual_information_from_counts(self.pairs, self.total, self.arities)
+        return mutual_information_matrix(self.codes, self.arities, n_jobs=n_jobs, weights=self.weights)
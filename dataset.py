@@ -0,0 +1,359 @@
+"""
+Compact columnar data sets: a matrix of small integer codes plus the values behind them.
+"""
+import json
+import os
+import numpy as np
+from itertools import islice
+
+MAGIC = b'CLTDATA1' # first bytes of a binary data set file
+ALIGNMENT = 64 # the code matrix starts at a multiple of this many bytes
+
+def code_dtype(arities):
+    """
+        Choose the smallest unsigned integer type able to hold every code.
+        arities: number of values of each variable.
+        return: numpy dtype for the code matrix.
+    """
+    largest = max(arities) if len(arities) else 0
+    if largest <= 1 << 8:
+        return np.dtype(np.uint8)
+    if largest <= 1 << 16:
+        return np.dtype(np.uint16)
+    return np.dtype(np.uint32)
+
+class Dataset:
+    __slots__ = ('codes', 'vocab', 'names', 'weights')
+
+    def __init__(self, codes, vocab, names=None, weights=None):
+        """
+            Initialization function
+            codes: N x n matrix with the code of every cell.
+            vocab: list with the values behind the codes of each variable.
+            names: variable names, '0', '1', ... by default.
+            weights: optional weight of every data point (how many times it counts).
+        """
+        self.codes = np.ascontiguousarray(codes, dtype=code_dtype([len(values) for values in vocab]))
+        self.vocab = list(vocab)
+        self.names = list(names) if names is not None else [str(var) for var in range(len(self.vocab))]
+        self.weights = None if weights is None else np.asarray(weights, dtype=float)
+        if self.weights is not None and self.weights.shape != (len(self.codes),):
+            raise ValueError("there must be one weight per data point")
+
+    @classmethod
+    def from_dict(cls, X):
+        """
+            Build a data set from a dictionary of value lists keyed by '0', '1', ...
+        """
+        columns = [np.asarray(X[str(var)]) for var in range(len(X))]
+        codes = np.empty((len(columns[0]) if columns else 0, len(columns)), dtype=np.intp)
+        vocab = []
+        for var, column in enumerate(columns):
+            # np.unique returns the sorted vocabulary and the code of every cell
+            values, inverse = np.unique(column, return_inverse=True)
+            codes[:, var] = inverse.ravel()
+            vocab.append(values)
+        return cls(codes, vocab)
+
+    @classmethod
+    def from_array(cls, array):
+        """
+            Build a data set from a numeric N x n matrix (e.g. the output of np.loadtxt).
+            Values are kept as their str() form, '0.0', '1.0', ...
+        """
+        array = np.atleast_2d(array)
+        codes = np.empty(array.shape, dtype=np.intp)
+        vocab = []
+        for var in range(array.shape[1]):
+            values, inverse = np.unique(array[:, var], return_inverse=True)
+            codes[:, var] = inverse.ravel()
+            vocab.append(np.array([str(value) for value in values]))
+        return cls(codes, vocab)
+
+    def take(self, rows):
+        """
+            Select some data points.
+            rows: slice or index array of the data points to keep.
+            return: Dataset sharing the vocabularies.
+        """
+        return Dataset(self.codes[rows], self.vocab, self.names, None if self.weights is None else self.weights[rows])
+
+    def compress(self):
+        """
+            Collapse identical data points into one weighted point each.
+            return: Dataset with the distinct data points (in sorted order) and their
+                total weight, so counting it gives the same counts as counting self.
+        """
+        codes = np.ascontiguousarray(self.codes)
+        # one opaque item per row makes np.unique compare whole data points at once
+        rows = codes.view(np.dtype((np.void, codes.dtype.itemsize * codes.shape[1]))).ravel()
+        unique, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+        weights = np.bincount(inverse.ravel(), weights=self.weights, minlength=len(unique))
+        return Dataset(codes[first], self.vocab, self.names, weights)
+
+    @property
+    def total(self):
+        """
+            Number of data points counted, the sum of the weights when weighted.
+        """
+        return len(self) if self.weights is None else np.sum(self.weights)
+
+    def row_values(self, row):
+        """
+            Decode a data point.
+            row: index of the data point.
+            return: list with the value of every variable.
+        """
+        return [self.vocab[var][code] for var, code in enumerate(self.codes[row].tolist())]
+
+    def save(self, path):
+        """
+            Write the data set in the binary format read by load_binary.
+            path: destination file.
+        """
+        with open(path, 'wb') as f:
+            write_header(f, MAGIC, {'shape': list(self.codes.shape), 'dtype': self.codes.dtype.str,
+                                    'vocab': [values.tolist() for values in self.vocab], 'names': self.names,
+                                    'weighted': self.weights is not None})
+            f.write(self.codes.tobytes())
+            if self.weights is not None: # float64 weights after the codes, aligned
+                f.write(b'\0' * (-self.codes.nbytes % ALIGNMENT))
+                f.write(self.weights.astype(np.float64).tobytes())
+
+    def to_dict(self):
+        """
+            Convert back to a dictionary of value lists keyed by '0', '1', ...
+        """
+        return {str(var): self.values(var).tolist() for var in range(self.n_vars)}
+
+    def values(self, var):
+        """
+            Decode the column of a variable.
+            var: index of the variable.
+            return: vector with the value of every data point.
+        """
+        return self.vocab[var][self.codes[:, var]]
+
+    def copy(self):
+        """
+            Copy the data set (codes and vocabularies).
+        """
+        weights = None if self.weights is None else self.weights.copy()
+        return Dataset(self.codes.copy(), [values.copy() for values in self.vocab], self.names, weights)
+
+    @property
+    def n_vars(self):
+        """
+            Number of variables.
+        """
+        return self.codes.shape[1]
+
+    @property
+    def arities(self):
+        """
+            Number of values of each variable.
+        """
+        return np.array([len(values) for values in self.vocab], dtype=np.intp)
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+def recode(dataset, vocab, rows=slice(None)):
+    """
+        Translate the codes of a data set to another set of vocabularies.
+        dataset: Dataset to translate.
+        vocab: list with the target values of each variable.
+        rows: slice of the data points to translate.
+        return: matrix of target codes, -1 where a value is not in the target vocabulary.
+    """
+    codes = dataset.codes[rows]
+    translated = np.empty(codes.shape, dtype=np.intp)
+    for var, values in enumerate(vocab):
+        index = {value: code for code, value in enumerate(values.tolist())}
+        lookup = np.array([index.get(value, -1) for value in dataset.vocab[var].tolist()], dtype=np.intp)
+        translated[:, var] = lookup[codes[:, var]]
+    return translated
+
+def as_dataset(X):
+    """
+        Accept a Dataset or the dictionary of value lists form of a data set.
+        X: data set.
+        return: the data set as a Dataset.
+    """
+    if X is None or isinstance(X, Dataset):
+        return X
+    return Dataset.from_dict(X)
+
+def write_header(f, magic, header):
+    """
+        Write a binary file header: magic bytes, header length and a JSON header,
+        padded so the data that follows is aligned.
+        f: file open for binary writing.
+        magic: 8 bytes identifying the format.
+        header: JSON-serializable dictionary.
+    """
+    encoded = json.dumps(header).encode('utf-8')
+    length = -(-(len(magic) + 8 + len(encoded)) // ALIGNMENT) * ALIGNMENT
+    f.write(magic)
+    f.write(np.uint64(length).tobytes())
+    f.write(encoded.ljust(length - len(magic) - 8, b' '))
+
+def read_header(path, magic):
+    """
+        Read the header written by write_header.
+        path: binary file.
+        magic: 8 bytes identifying the expected format.
+        return: header dictionary and the offset where the data starts.
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(magic)) != magic:
+            raise ValueError("%s is not a %s file" % (path, magic.decode('ascii')))
+        length = int(np.frombuffer(f.read(8), dtype=np.uint64)[0])
+        header = json.loads(f.read(length - len(magic) - 8).decode('utf-8'))
+    return header, length
+
+def write_arrays(f, magic, header, arrays):
+    """
+        Write a header followed by named arrays, each one aligned so it can be memory-mapped in place.
+        f: file open for binary writing.
+        magic: 8 bytes identifying the format.
+        header: JSON-serializable dictionary, the array layout is added under 'arrays'.
+        arrays: list of (name, array) pairs.
+    """
+    layout, position = {}, 0
+    for name, array in arrays:
+        layout[name] = [array.dtype.str, list(array.shape), position]
+        position += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+    write_header(f, magic, dict(header, arrays=layout))
+    for name, array in arrays:
+        data = np.ascontiguousarray(array).tobytes()
+        f.write(data.ljust(-(-len(data) // ALIGNMENT) * ALIGNMENT, b'\0'))
+
+def read_arrays(path, magic):
+    """
+        Open a file written by write_arrays without copying its arrays into memory.
+        path: binary file.
+        magic: 8 bytes identifying the expected format.
+        return: header dictionary and a dictionary of read-only arrays backed by one memory map.
+    """
+    header, offset = read_header(path, magic)
+    size = os.path.getsize(path) - offset
+    buffer = np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=(size,)) if size else None
+    arrays = {}
+    for name, (dtype, shape, position) in header.pop('arrays').items():
+        if buffer is None or np.prod(shape) == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=buffer, offset=position)
+    return header, arrays
+
+def load_binary(path):
+    """
+        Open a binary data set without copying the codes into memory.
+        path: file written by Dataset.save or encode_csv.
+        return: Dataset whose code matrix (and weights) are read-only memory maps.
+    """
+    header, offset = read_header(path, MAGIC)
+    shape = tuple(header['shape'])
+    weights = None
+    if shape[0] == 0:
+        codes = np.zeros(shape, dtype=header['dtype'])
+        weights = np.zeros(0) if header.get('weighted') else None
+    else:
+        codes = np.memmap(path, dtype=header['dtype'], mode='r', offset=offset, shape=shape)
+        if header.get('weighted'):
+            start = offset + -(-codes.nbytes // ALIGNMENT) * ALIGNMENT
+            weights = np.memmap(path, dtype=np.float64, mode='r', offset=start, shape=(shape[0],))
+    return Dataset(codes, [np.array(values) for values in header['vocab']], header['names'], weights)
+
+def read_chunks(path, chunk_rows=65536, delimiter=',', numeric=True):
+    """
+        Read a delimited text file a fixed number of lines at a time.
+        path: text file with one data point per line.
+        chunk_rows: number of lines per chunk.
+        delimiter: column separator.
+        numeric: parse the cells as numbers (like np.loadtxt) instead of keeping the raw text.
+        return: generator of chunks (float or string matrices).
+    """
+    with open(path) as f:
+        while True:
+            lines = [line for line in islice(f, chunk_rows) if line.strip()]
+            if not lines:
+                return
+            if numeric:
+                yield np.loadtxt(lines, delimiter=delimiter, ndmin=2)
+            else:
+                yield np.array([line.rstrip('\r\n').split(delimiter) for line in lines])
+
+def encode_csv(path, out_path, chunk_rows=65536, delimiter=',', numeric=True):
+    """
+        Encode a delimited text file into the binary data set format, one chunk at a time,
+        so only a chunk of the data is ever held in memory.
+        path: text file with one data point per line.
+        out_path: destination binary file.
+        chunk_rows: number of lines parsed at a time.
+        delimiter: column separator.
+        numeric: parse the cells as numbers; values are kept as their str() form.
+        return: Dataset memory-mapping out_path.
+    """
+    tmp_path = out_path + '.tmp'
+    index = None # value -> first-seen code of each column
+    rows = 0
+    with open(tmp_path, 'wb') as tmp:
+        for chunk in read_chunks(path, chunk_rows, delimiter, numeric):
+            if index is None:
+                index = [{} for _ in range(chunk.shape[1])]
+            codes = np.empty(chunk.shape, dtype=np.uint32)
+            for var, seen in enumerate(index):
+                # only the distinct values of the chunk go through python
+                values, inverse = np.unique(chunk[:, var], return_inverse=True)
+                lookup = np.array([seen.setdefault(value, len(seen)) for value in values.tolist()], dtype=np.uint32)
+                codes[:, var] = lookup[inverse.ravel()]
+            tmp.write(codes.tobytes())
+            rows += len(chunk)
+    index = index or []
+    # renumber the codes so each vocabulary is sorted, as in Dataset.from_array / from_dict
+    vocab, remaps = [], []
+    for seen in index:
+        values = sorted(seen)
+        remap = np.empty(len(values), dtype=np.intp)
+        remap[[seen[value] for value in values]] = np.arange(len(values))
+        vocab.append(np.array([str(value) for value in values]))
+        remaps.append(remap)
+    dtype = code_dtype([len(values) for values in vocab])
+    n = len(index)
+    with open(tmp_path, 'rb') as tmp, open(out_path, 'wb') as f:
+        write_header(f, MAGIC, {'shape': [rows, n], 'dtype': dtype.str,
+                                'vocab': [values.tolist() for values in vocab],
+                                'names': [str(var) for var in range(n)]})
+        while n:
+            codes = np.frombuffer(tmp.read(chunk_rows * n * 4), dtype=np.uint32).reshape(-1, n)
+            if not len(codes):
+                break
+            sorted_codes = np.empty(codes.shape, dtype=dtype)
+            for var in range(n):
+                sorted_codes[:, var] = remaps[var][codes[:, var]]
+            f.write(sorted_codes.tobytes())
+    os.remove(tmp_path)
+    return load_binary(out_path)
+
+def is_binary(path):
+    """
+        Whether a file is a binary data set (written by Dataset.save or encode_csv).
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def load_data(path, chunk_rows=65536, delimiter=',', numeric=True):
+    """
+        Load a delimited text file through its binary cache (path + '.codes'), encoding
+        it on the first run or when the text file is newer than the cache.
+        path: text file with one data point per line, or a binary data set.
+        return: Dataset memory-mapping the cache.
+    """
+    if is_binary(path):
+        return load_binary(path)
+    cache_path = path + '.codes'
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(path):
+        return load_binary(cache_path)
+    return encode_csv(path, cache_path, chunk_rows, delimiter, numeric)
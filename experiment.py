@@ -0,0 +1,182 @@
+"""
+Seeded perturbation experiments comparing a Chow-Liu tree with a perturbed copy of itself.
+"""
+import csv
+import os
+import numpy as np
+from multiprocessing import Pool
+from chow_liu_tree import Chow_Liu_Tree
+from dataset import is_binary, load_binary, load_data
+from metric import Metric
+
+METRICS = ('mid', 'jsd', 'kld', 'joint_kld', 'joint_jsd') # everything Metric.compare records
+
+def result_columns(metrics):
+    """
+        Columns of the results of an experiment recording the given metrics.
+    """
+    return ['replication', 'iteration', 'inference'] + list(metrics)
+
+COLUMNS = result_columns(('mid', 'jsd', 'kld', 'joint_jsd')) # recorded by default
+
+def perturb(clt, rng, attempts=100):
+    """
+        Change one random cell of the data of a tree to a value drawn from the same
+        column, keeping every variable's set of values (at most attempts tries).
+        clt: Chow Liu Tree whose count store holds a writable code matrix.
+        rng: numpy random generator.
+        attempts: number of cells tried before giving up.
+        return: whether a cell was changed.
+    """
+    counts = clt.counts
+    for _ in range(attempts):
+        var = rng.integers(len(counts.arities))
+        row = rng.integers(len(counts.codes))
+        current = counts.codes[row, var]
+        # same distribution as picking the value of a random data point of the column
+        new = rng.choice(counts.arities[var], p=counts.marginals[var] / counts.total)
+        if new == current or counts.marginals[var][current] == 1:
+            continue # no change, or the current value would disappear from the column
+        clt.replace(row, var, counts.vocab[var][new])
+        return True
+    return False
+
+def resample(clt, rng):
+    """
+        Replace one random data point of a tree with a point sampled from the tree itself,
+        keeping the cells whose current value would disappear from their column.
+        clt: trained Chow Liu Tree whose count store holds a writable code matrix.
+        rng: numpy random generator.
+        return: whether a cell was changed.
+    """
+    counts = clt.counts
+    row = rng.integers(len(counts.codes))
+    new = next(clt.sample_chunks(1, rng))[0]
+    changed = []
+    for var, code in enumerate(new.tolist()):
+        current = counts.codes[row, var]
+        if code != current and counts.marginals[var][current] > 1:
+            counts.replace_cell(row, var, code)
+            changed.append(var)
+    if changed:
+        clt.refresh(changed)
+    return len(changed) > 0
+
+PERTURBATIONS = {'cell': perturb, 'sample': resample}
+
+def run_replication(task):
+    """
+        Run one replication: compare a tree with a copy that gets one perturbed cell per iteration.
+        task: tuple (replication, seed, data_path, iterations, metrics, perturbation, alpha).
+        return: replication number and a dictionary of result columns.
+    """
+    replication, seed, data_path, iterations, metrics, perturbation, alpha = task
+    rng = np.random.default_rng([seed, replication])
+    data = load_binary(data_path)
+    clt = Chow_Liu_Tree(data)
+    clt.build_clt()
+    clt2 = Chow_Liu_Tree(data.copy()) # the perturbed tree owns a writable copy of the codes
+    clt2.build_clt()
+    metric = Metric(alpha=alpha)
+    results = dict((column, np.full(iterations, np.nan)) for column in result_columns(metrics))
+    results['replication'][:] = replication
+    results['iteration'][:] = np.arange(iterations)
+    for i in range(iterations):
+        results['inference'][i] = metric.conditional_probability_tests(clt, clt2)
+        for name, value in metric.compare(clt, clt2, metrics).items():
+            results[name][i] = value
+        PERTURBATIONS[perturbation](clt2, rng)
+    return replication, results
+
+def run_experiment(data_path, results_path, replications=1, iterations=500, seed=0, n_jobs=1,
+                   metrics=("mid", "jsd", "kld", "joint_jsd"), perturbation='cell', alpha=0.0):
+    """
+        Run independent, seeded replications of the perturbation experiment over a process pool,
+        writing every replication to the results file as soon as it finishes.
+        data_path: text data file (encoded to its binary cache once) or binary data set.
+        results_path: destination .csv (streamed) or .npz (written at the end) file.
+        replications: number of independent replications.
+        iterations: number of perturbations per replication.
+        seed: base seed; replication r uses the seed sequence [seed, r].
+        n_jobs: number of worker processes.
+        metrics: divergences recorded next to the inference similarity.
+        perturbation: 'cell' changes one random cell per iteration, 'sample' replaces a random
+            data point with one sampled from the perturbed tree.
+        alpha: Laplace smoothing of the CPTs compared by joint_kld (see Metric).
+        return: path of the results file.
+    """
+    if not is_binary(data_path):
+        load_data(data_path) # parse once here, the workers memory-map the cache
+        data_path = data_path + '.codes'
+    if perturbation not in PERTURBATIONS:
+        raise ValueError("unknown perturbation: %s" % perturbation)
+    unknown = [metric for metric in metrics if metric not in METRICS]
+    if unknown:
+        raise ValueError("unknown metrics: %s" % ", ".join(unknown))
+    columns = result_columns(metrics)
+    tasks = [(replication, seed, data_path, iterations, list(metrics), perturbation, alpha) for replication in range(replications)]
+    pool = Pool(n_jobs) if n_jobs > 1 else None
+    try:
+        results = pool.imap_unordered(run_replication, tasks) if pool else (run_replication(task) for task in tasks)
+        if results_path.endswith('.npz'):
+            parts = [part for _, part in sorted(results, key=lambda result: result[0])]
+            save_results(results_path, dict((column, np.concatenate([part[column] for part in parts])) for column in columns))
+        else:
+            with open(results_path, 'w') as f:
+                writer = csv.writer(f)
+                writer.writerow(columns)
+                for _, part in results:
+                    writer.writerows(zip(*[part[column] for column in columns]))
+                    f.flush()
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return results_path
+
+def save_results(results_path, results):
+    """
+        Write result columns to a .csv or .npz file.
+        results_path: destination file.
+        results: dictionary from column name to a vector of values, in column order.
+    """
+    if results_path.endswith('.npz'):
+        np.savez(results_path, **results)
+        return
+    with open(results_path, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(list(results))
+        writer.writerows(zip(*results.values()))
+
+def load_results(results_path):
+    """
+        Read a results file written by run_experiment.
+        return: dictionary from column name to a vector of values.
+    """
+    if results_path.endswith('.npz'):
+        with np.load(results_path) as results:
+            return dict((column, results[column]) for column in results.files)
+    table = np.genfromtxt(results_path, delimiter=',', names=True)
+    return dict((column, np.atleast_1d(table[column])) for column in table.dtype.names)
+
+def plot_results(results_path, out_dir='.'):
+    """
+        Scatter the inference similarity against every recorded metric, one PNG per metric.
+        results_path: file written by run_experiment.
+        out_dir: directory for the images.
+        return: list of written image paths.
+    """
+    import matplotlib.pyplot as plt
+    results = load_results(results_path)
+    paths = []
+    for column in [column for column in results if column not in COLUMNS[:3]]:
+        if np.all(np.isnan(results[column])):
+            continue
+        plt.figure()
+        plt.xlabel("Inference")
+        plt.ylabel(column)
+        plt.scatter(100 * results['inference'], 100 * results[column])
+        paths.append(os.path.join(out_dir, column + '.png'))
+        plt.savefig(paths[-1])
+        plt.close()
+    return paths
@@ -0,0 +1,302 @@
+"""
+Batched evidence inference (sum-product and max-product message passing) on Chow-Liu trees.
+"""
+import numpy as np
+from collections import OrderedDict
+from profiling import stats
+
+def normalize(beliefs):
+    """
+        Scale every row of a batch of beliefs to sum 1 (rows without mass stay zero).
+    """
+    total = beliefs.sum(axis=1, keepdims=True)
+    return np.divide(beliefs, total, out=np.zeros_like(beliefs), where=total > 0)
+
+def tree_log_likelihood(parents, order, log_cpts, codes):
+    """
+        Evaluate a tree factorization for a batch of data points.
+        parents and order: structure of the tree (see Belief_Propagation).
+        log_cpts: natural logarithm of the CPTs.
+        codes: m x n matrix with the codes of the data points.
+        return: vector with the natural log probability of every data point.
+    """
+    root = order[0]
+    likelihood = log_cpts[root][codes[:, root]]
+    for child in order[1:]:
+        likelihood += log_cpts[child][codes[:, parents[child]], codes[:, child]]
+    return likelihood
+
+def cumulative_cpts(cpts):
+    """
+        Lay the cumulative rows of every CPT end to end, row r shifted by r, so a single
+        searchsorted of uniform draws shifted by the parent codes samples a whole batch.
+        cpts: root marginal and p(child | parent) table of every other variable.
+        return: list with the flat shifted cumulative table of every variable.
+    """
+    cumulative = []
+    for cpt in cpts:
+        cdf = np.cumsum(np.atleast_2d(cpt), axis=1)
+        # exact 1 at the end of every row with mass, so a draw never falls past the last value
+        cdf = np.divide(cdf, cdf[:, -1:], out=np.zeros_like(cdf), where=cdf[:, -1:] > 0)
+        cumulative.append((cdf + np.arange(len(cdf))[:, None]).ravel())
+    return cumulative
+
+def ancestral_sample(parents, order, cumulative, arities, size, rng, dtype=np.intp):
+    """
+        Draw data points from a tree, every variable for the whole batch at once, in
+        topological order.
+        parents and order: structure of the tree (see Belief_Propagation).
+        cumulative: tables from cumulative_cpts.
+        arities: number of values of each variable.
+        size: number of data points.
+        rng: numpy random generator.
+        dtype: type of the codes.
+        return: size x n matrix of codes.
+    """
+    root = order[0]
+    codes = np.empty((size, len(parents)), dtype=dtype)
+    codes[:, root] = np.searchsorted(cumulative[root], rng.random(size), side='right')
+    for child in order[1:]:
+        parent_codes = codes[:, parents[child]].astype(np.intp)
+        position = np.searchsorted(cumulative[child], rng.random(size) + parent_codes, side='right')
+        codes[:, child] = position - parent_codes * arities[child]
+    return codes
+
+class Belief_Propagation:
+    def __init__(self, parents, order, cpts, cache_size=64, cache_rows=1024, cache_bytes=1 << 26):
+        """
+            Initialization function
+            parents: vector with the parent of each variable (-1 for the root).
+            order: variables in topological order, root first.
+            cpts: root marginal and arity(parent) x arity(child) table of p(child | parent)
+                of every other variable.
+            cache_size: number of evidence batches whose results are kept.
+            cache_rows: largest batch whose results are kept (larger ones are always computed,
+                so high-throughput batches never pile up in memory).
+            cache_bytes: largest total size of the kept results.
+        """
+        self.parents = parents
+        self.order = order
+        self.cpts = cpts
+        self.root = order[0]
+        self.arities = [cpt.shape[-1] for cpt in cpts]
+        self.children = [[] for _ in parents]
+        for child in order[1:]:
+            self.children[parents[child]].append(child)
+        self.schedules = {} # evidence pattern -> variables that send upward messages
+        self._free = None # max-product messages of subtrees without evidence, see free_messages
+        self.cache = OrderedDict() # (kind, evidence) -> (results, bytes), least recently used first
+        self.cache_size = cache_size
+        self.cache_rows = cache_rows
+        self.cache_bytes = cache_bytes
+        self.cached_bytes = 0
+
+    def schedule(self, observed):
+        """
+            Find the variables with evidence somewhere below them; for sum-product all the
+            other upward messages are uniform and are skipped. Cached per evidence pattern.
+            observed: tuple with the observed variables.
+            return: boolean vector marking the variables that send upward messages.
+        """
+        if observed not in self.schedules:
+            active = np.zeros(len(self.parents), dtype=bool)
+            active[list(observed)] = True
+            for node in self.order[:0:-1]:
+                if active[node]:
+                    active[self.parents[node]] = True
+            self.schedules[observed] = active
+        return self.schedules[observed]
+
+    def indicators(self, evidence, var):
+        """
+            Evidence of a variable as a batch of indicator rows.
+            evidence: B x n matrix of codes, -1 where the variable is not observed and
+                arity (or more) for observed values with no probability.
+            var: index of the variable.
+            return: B x arity matrix (all ones where the variable is not observed).
+        """
+        codes = evidence[:, var]
+        arity = self.arities[var]
+        rows = np.ones((len(codes), arity))
+        observed = codes >= 0
+        rows[observed] = 0
+        known = observed & (codes < arity)
+        rows[np.nonzero(known)[0], codes[known]] = 1
+        return rows
+
+    def free_messages(self):
+        """
+            Max-product messages of the variables with no evidence below them. Unlike the
+            sum-product ones they are not uniform (max_c p(c | p) depends on p), but they are
+            the same for every evidence row, so they are computed once.
+            return: message and best child value for every parent value of every variable,
+                1 x arity(parent) each (None for the root).
+        """
+        if self._free is None:
+            messages, best = [None] * len(self.parents), [None] * len(self.parents)
+            for node in self.order[:0:-1]:
+                lam = np.ones((1, self.arities[node]))
+                for child in self.children[node]:
+                    lam = lam * messages[child]
+                weighted = self.cpts[node][None, :, :] * lam[:, None, :]
+                best[node] = weighted.argmax(axis=2)
+                message = weighted.max(axis=2)
+                scale = message.max(axis=1, keepdims=True)
+                messages[node] = np.divide(message, scale, out=np.zeros_like(message), where=scale > 0)
+            self._free = (messages, best)
+        return self._free
+
+    def upward(self, evidence, kind):
+        """
+            Send the messages from the leaves to the root.
+            evidence: B x n matrix of codes (see indicators).
+            kind: 'marginal' (sum-product) or 'map' (max-product).
+            return: lambda of every variable (evidence below it, None when uniform),
+                the message every variable sends its parent and, for 'map', the
+                best child value for every parent value.
+        """
+        active = self.schedule(tuple(np.nonzero((evidence >= 0).any(axis=0))[0]))
+        lambdas, messages, best = [None] * len(self.parents), [None] * len(self.parents), [None] * len(self.parents)
+        for node in self.order[::-1]:
+            if kind == 'map' and not active[node] and node != self.root:
+                free_messages, free_best = self.free_messages()
+                messages[node] = free_messages[node] # broadcast over the batch
+                best[node] = np.broadcast_to(free_best[node], (len(evidence), free_best[node].shape[1]))
+                continue
+            if not active[node] and not (kind == 'map' and node == self.root):
+                continue
+            lam = self.indicators(evidence, node)
+            for child in self.children[node]:
+                if messages[child] is not None:
+                    lam *= messages[child]
+            lambdas[node] = lam
+            if node == self.root:
+                continue
+            if kind == 'map':
+                weighted = self.cpts[node][None, :, :] * lam[:, None, :] # B x parent value x child value
+                best[node] = weighted.argmax(axis=2)
+                message = weighted.max(axis=2)
+            else:
+                message = lam.dot(self.cpts[node].T)
+            # rescale to avoid underflow; a constant factor per row does not change the result
+            scale = message.max(axis=1, keepdims=True)
+            messages[node] = np.divide(message, scale, out=np.zeros_like(message), where=scale > 0)
+        return lambdas, messages, best
+
+    def marginals(self, evidence, targets=None):
+        """
+            Posterior marginals given the evidence (sum-product).
+            evidence: B x n matrix of codes (see indicators).
+            targets: variables to return, all of them by default.
+            return: dictionary from target to a B x arity matrix of posterior probabilities.
+        """
+        evidence = np.asarray(evidence, dtype=np.intp)
+        targets = range(len(self.parents)) if targets is None else targets
+        key = self.cache_key('marginal', evidence)
+        beliefs = self.recall(key)
+        if beliefs is None:
+            stats.count('inference.sum_product_rows', len(evidence))
+            lambdas, messages, _ = self.upward(evidence, 'marginal')
+            batch = len(evidence)
+            pis = [None] * len(self.parents) # evidence above each variable, times its prior
+            pis[self.root] = np.tile(self.cpts[self.root], (batch, 1))
+            beliefs = [None] * len(self.parents)
+            for node in self.order:
+                lam = lambdas[node] if lambdas[node] is not None else self.indicators(evidence, node)
+                beliefs[node] = normalize(pis[node] * lam)
+                children = self.children[node]
+                if not children:
+                    continue
+                # pass down everything but the child's own message (prefix/suffix products)
+                outside = pis[node] * self.indicators(evidence, node)
+                incoming = [messages[child] for child in children]
+                suffix = [None] * len(children)
+                running = None
+                for i in range(len(children) - 1, -1, -1):
+                    suffix[i] = running
+                    if incoming[i] is not None:
+                        running = incoming[i] if running is None else running * incoming[i]
+                prefix = outside
+                for i, child in enumerate(children):
+                    down = prefix if suffix[i] is None else prefix * suffix[i]
+                    pis[child] = normalize(down).dot(self.cpts[child])
+                    if incoming[i] is not None:
+                        prefix = prefix * incoming[i]
+            self.remember(key, beliefs)
+        return dict((target, beliefs[target]) for target in targets)
+
+    def map(self, evidence, targets=None):
+        """
+            Most probable joint assignment given the evidence (max-product).
+            evidence: B x n matrix of codes (see indicators).
+            targets: variables to return, all of them by default.
+            return: dictionary from target to a vector with its code in every assignment.
+        """
+        evidence = np.asarray(evidence, dtype=np.intp)
+        targets = range(len(self.parents)) if targets is None else targets
+        key = self.cache_key('map', evidence)
+        assignment = self.recall(key)
+        if assignment is None:
+            stats.count('inference.max_product_rows', len(evidence))
+            lambdas, _, best = self.upward(evidence, 'map')
+            batch = np.arange(len(evidence))
+            assignment = np.zeros((len(evidence), len(self.parents)), dtype=np.intp)
+            lam = lambdas[self.root] if lambdas[self.root] is not None else self.indicators(evidence, self.root)
+            assignment[:, self.root] = (self.cpts[self.root] * lam).argmax(axis=1)
+            for node in self.order[1:]:
+                assignment[:, node] = best[node][batch, assignment[:, self.parents[node]]]
+            self.remember(key, assignment)
+        return dict((target, assignment[:, target]) for target in targets)
+
+    def pairwise(self, pairs):
+        """
+            Joint distribution of pairs of variables, adjacent in the tree or not.
+            pairs: list of (u, v) variable pairs.
+            return: dictionary from (u, v) to an arity(u) x arity(v) matrix of p(u, v).
+        """
+        n = len(self.parents)
+        priors = self.marginals(np.full((1, n), -1, dtype=np.intp))
+        firsts = sorted(set(u for u, _ in pairs))
+        # a single batch with one evidence row per value of every conditioning variable
+        starts = np.concatenate(([0], np.cumsum([self.arities[u] for u in firsts])))
+        evidence = np.full((starts[-1], n), -1, dtype=np.intp)
+        for u, start, stop in zip(firsts, starts[:-1], starts[1:]):
+            evidence[start:stop, u] = np.arange(stop - start)
+        posteriors = self.marginals(evidence, sorted(set(v for _, v in pairs)))
+        joints = {}
+        for u, start, stop in zip(firsts, starts[:-1], starts[1:]):
+            for v in set(v for first, v in pairs if first == u):
+                joints[(u, v)] = priors[u][0][:, None] * posteriors[v][start:stop]
+        return joints
+
+    def cache_key(self, kind, evidence):
+        """
+            Key of the results of an evidence batch, None for batches too large to keep.
+        """
+        if len(evidence) > self.cache_rows:
+            return None
+        return (kind, evidence.shape, evidence.tobytes())
+
+    def remember(self, key, value):
+        """
+            Store a result, dropping the least recently used ones above the cache size or bytes.
+        """
+        if key is None:
+            return
+        size = sum(array.nbytes for array in value) if isinstance(value, list) else value.nbytes
+        if size > self.cache_bytes:
+            return
+        self.cache[key] = (value, size)
+        self.cached_bytes += size
+        while len(self.cache) > self.cache_size or self.cached_bytes > self.cache_bytes:
+            self.cached_bytes -= self.cache.popitem(last=False)[1][1]
+
+    def recall(self, key):
+        """
+            Fetch a stored result and mark it as recently used.
+            return: the result, None if it is not stored.
+        """
+        if key not in self.cache:
+            return None
+        self.cache.move_to_end(key)
+        return self.cache[key][0]
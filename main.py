@@ -1,60 +1,80 @@
-from chow_liu_tree import Chow_Liu_Tree 
-import matplotlib.pyplot as plt
+"""
+Command line entry point.
+
+    python main.py train data/abalone.test.data --plot tree.png --out abalone.clt
+    python main.py compare data/abalone.test.data data/abalone.ts.data
+    python main.py experiment data/abalone.test.data --iterations 500 --plot-dir .
+    python main.py score abalone.clt data/abalone.test.data
+    python main.py classify data/abalone.ts.data data/abalone.test.data --label 0
+"""
+import argparse
+import contextlib
+import sys
 import numpy as np
-import random
-from copy import deepcopy as dc
+from chow_liu_tree import MODEL_MAGIC, Chow_Liu_Tree
+from classifier import Chow_Liu_Classifier, split_labels
+from dataset import Dataset, load_data
+from experiment import COLUMNS, METRICS, plot_results, result_columns, run_experiment, save_results
 from metric import Metric
-
-def perturbate_distribution(X, X2):
-    X_aux = X2
-    while(True):
-        variable = random.choice(X2.keys())
-        new_val_index = random.choice(range(len(X2[variable]) - 1))
-        current_val = X2[variable][new_val_index]
-        X2[variable][new_val_index] = random.choice(X2[variable])
-        if set(X[variable]) == set(X2[variable]):
-            return X2
-        else:
-            X2[variable][new_val_index] = current_val
-
+from profiling import profiled_run
 
 def split_data(X):
-    return np.split(X, 2)
+    half = len(X) // 2
+    return X.take(slice(0, half)), X.take(slice(half, 2 * half))
 
-if __name__ == "__main__":
-    split_testing = False
-    file_txt = np.loadtxt('data/abalone.test.data', delimiter=',')
-    #print(file_txt)
-    #import sys
-    #sys.exit()
-
-    data = []
-    for line in file_txt.T:
-        d_aux = []
-        for num in line:
-            d_aux.append(str(num))
-        data.append(d_aux)
-    
-    points_stack = []
-
-    if split_testing:
-        data1_full, data2_full = split_data(file_txt)
-        for point_d1, point_d2 in zip(data1_full[::-1], data2_full[::-1]):
-            points_stack.append((point_d1, point_d2))
-        points = points_stack.pop()
-        new_point1, new_point2 = points[0], points[1]
-        X = {str(i) : [str(e)] for i, e in enumerate(new_point1)}
-        X2 = {str(i) : [str(e)] for i, e in enumerate(new_point2)}
-    else:
-        X = {str(i) : e for i, e in enumerate(data)}
-        X2 = dc(X)
+def train(data_path, n_jobs=1, compress=False, weights_path=None, sparse=False):
+    """
+        Build a tree on a data file.
+        compress: count every distinct data point once, weighted by its number of copies.
+        sparse: find the tree of binary data with acCL (see Chow_Liu_Tree).
+        weights_path: optional text file with the weight of every data point, one per line.
+    """
+    data = load_data(data_path) # parsed once, memory-mapped on later runs
+    if weights_path:
+        data = Dataset(data.codes, data.vocab, data.names, np.atleast_1d(np.loadtxt(weights_path)))
+    clt = Chow_Liu_Tree(data, compress=compress, sparse=sparse)
+    clt.build_clt(n_jobs)
+    return clt
+
+def model(path, n_jobs=1, compress=False, sparse=False):
+    """
+        Load a tree saved by train --out, or build one on a data file.
+    """
+    with open(path, 'rb') as f:
+        saved = f.read(len(MODEL_MAGIC)) == MODEL_MAGIC
+    return Chow_Liu_Tree.load(path) if saved else train(path, n_jobs, compress, sparse=sparse)
 
-    #print(X)
-    #print(X2)
-    #import sys
-    #sys.exit()
-    
+def split_experiment(data_path, results_path, metrics=COLUMNS[3:], alpha=0.0):
+    """
+        Start a tree on the first point of each half of the data and learn the rest of
+        each half one point at a time, comparing both trees after every point.
+        metrics: divergences recorded next to the inference similarity.
+        alpha: Laplace smoothing of the CPTs compared by joint_kld (see Metric).
+    """
+    data = load_data(data_path)
+    data1_full, data2_full = split_data(data)
+    X = Dataset.from_dict({str(i) : [e] for i, e in enumerate(data1_full.row_values(0))})
+    X2 = Dataset.from_dict({str(i) : [e] for i, e in enumerate(data2_full.row_values(0))})
+    clt = Chow_Liu_Tree(X)
+    clt2 = Chow_Liu_Tree(X2)
+    clt.build_clt()
+    clt2.build_clt()
+    metric = Metric(alpha=alpha)
+    iterations = len(data1_full) - 1
+    results = dict((column, np.zeros(iterations)) for column in result_columns(metrics))
+    results['iteration'][:] = np.arange(iterations)
+    for i in range(iterations):
+        results['inference'][i] = metric.conditional_probability_tests(clt, clt2)
+        for name, value in metric.compare(clt, clt2, metrics).items(): # every metric in one pass
+            results[name][i] = value
+        # learn the new points incrementally instead of rebuilding both trees
+        clt.update([data1_full.row_values(i + 1)])
+        clt2.update([data2_full.row_values(i + 1)])
+    save_results(results_path, results)
 
+def toy_example():
+    """
+        Print probabilities and MI of a small hand-made data set.
     """
     X = {
      '0': ['A','A','A','G','A'],
@@ -62,121 +82,172 @@ if __name__ == "__main__":
      '2': ['C','G','G','T','T'],
      '3': ['C','C','C','C','C'],
     }
+    X2 = dict((var, list(values)) for var, values in X.items())
+    clt = Chow_Liu_Tree(X)
+    clt2 = Chow_Liu_Tree(X2)
+    print("marginal of 0 = A: " + str(clt.marginal_probability('0', 'A')))
+    print("marginal of 0 = G: " + str(clt.marginal_probability('0', 'G')))
+    print("marginal of 1 = A: " + str(clt.marginal_probability('1', 'A')))
+    print("marginal of 1 = C: " + str(clt.marginal_probability('1', 'C')))
+    print("marginal of 2 = C: " + str(clt.marginal_probability('2', 'C')))
+    print("marginal of 2 = T: " + str(clt.marginal_probability('2', 'T')))
+    print("marginal of 2 = G: " + str(clt.marginal_probability('2', 'G')))
+    print("marginal of 3 = C: " + str(clt.marginal_probability('3', 'C')))
+    print("------")
+    print("joint of 0 = A and 1 = A: " + str(clt.joint_probability('0', '1', 'A', 'A')))
+    print("joint of 0 = G and 1 = C: " + str(clt.joint_probability('0', '1', 'G', 'C')))
+    print("joint of 0 = A and 1 = C: " + str(clt.joint_probability('0', '1', 'A', 'C')))
+    print("joint of 1 = A and 2 = A: " + str(clt.joint_probability('1', '2', 'A', 'G')))
+    print("joint of 1 = G and 2 = C: " + str(clt.joint_probability('1', '2', 'C', 'T')))
+    print("joint of 1 = A and 2 = C: " + str(clt.joint_probability('1', '2', 'A', 'C')))
+    print("------")
+    for v in range(len(X)):
+        for u in range(v):
+            print("mi " + str(u) + " and " + str(v) + ": " + str(clt.mutual_information(str(u), str(v))))
+    print('------')
+    print(clt.conditional_probability('1', '0', 'A', 'A'))
+    print(clt.conditional_probability('1', '0', 'C', 'A'))
+    print('----')
+    print(clt.conditional_probability('1', '0', 'A', 'G'))
+    print(clt.conditional_probability('1', '0', 'C', 'G'))
+    print("clt2")
+    print('------')
+    print(clt2.conditional_probability('1', '0', 'A', 'A'))
+    print(clt2.conditional_probability('1', '0', 'C', 'A'))
+    print('----')
+    print(clt2.conditional_probability('1', '0', 'A', 'G'))
+    print(clt2.conditional_probability('1', '0', 'C', 'G'))
 
-    X2 = {
-     '0': ['A','A','A','G','A'],    
-     '1': ['A','A','A','C','C'],
-     '2': ['C','G','G','T','T'],
-     '3': ['C','C','C','C','C'],
-    }
+def headless_plots():
     """
-
-    fig = plt.figure()
-    divergences = []
-    divergences2 = []
-    divergences3 = []
-    metric = Metric()
-    iterations = len(points_stack) if split_testing else 500
-    for i in range(iterations):
-        
-        values = [val for _, vals in X.items() for val in vals]
-        clt = Chow_Liu_Tree(X)
-        clt2 = Chow_Liu_Tree(X2)
-        
-        clt.build_clt()
-        clt2.build_clt()
-        
-        structure_diff = 100 * round(metric.divergence(clt, clt2, "mid"), 7)
-        inference_diff = 100 * round(metric.conditional_probability_tests(clt, clt2), 7)
-        #print('hi')
-        #print("clt and clt2 are: ", str(structure_diff) + "% ", "the same structure.")
-        #print("clt and clt2 are: ", str(inference_diff) + "% ", "the same at inference.")
-        #divergences.append((structure_diff, inference_diff))
-        divergences.append((inference_diff, 100 * metric.divergence(clt, clt2, "jsd")))
-        divergences2.append((inference_diff, 100 * metric.divergence(clt, clt2, "kld")))
-        divergences3.append((inference_diff, structure_diff))
-        # compute marginals, joints and conditionals for testing
-        
-        if split_testing:
-            points = points_stack.pop()
-            new_point1, new_point2 = points[0], points[1]
-            for i, val in enumerate(new_point1):
-                X[str(i)].append(str(val))
-            for i, val in enumerate(new_point2):
-                X2[str(i)].append(str(val))
-        else:
-            X2 = perturbate_distribution(X, X2)
-        #print(X)
-        #print(X2)
-    
-    #print(divergences)
-    #plt.xlabel("Structure")
-    #plt.xlabel(metric_name)
-    #plt.scatter(*zip(*divergences))
-    #clt.plot()
-    #clt2.plot()
-    #print(X)
-    #print(X2)
-    #clt2.plot()
+        Render the plots of the command line straight to files, never opening a window.
     """
-    fig1 = plt.figure()
-    ax1 = fig1.add_subplot(111)
-    ax1.scatter(*zip(*divergences))
-    ax1.set_xlabel('x')
-    ax1.set_ylabel('y')
+    import matplotlib
+    matplotlib.use('Agg')
+
+def command_train(args):
+    clt = train(args.data, args.jobs, args.compress, args.weights, args.sparse)
+    for child in clt.order[1:]:
+        parent = clt.parents[child]
+        print("%d %d %.6f" % (parent, child, clt.mutual_information(parent, child)))
+    if args.plot:
+        headless_plots()
+        clt.plot(args.plot)
+    if args.out:
+        clt.save(args.out)
+
+def command_compare(args):
+    clt = train(args.data1, args.jobs, args.compress, sparse=args.sparse)
+    clt2 = train(args.data2, args.jobs, args.compress, sparse=args.sparse)
+    metric = Metric(alpha=args.alpha)
+    print("inference %.6f" % metric.conditional_probability_tests(clt, clt2, queries=args.queries, source=args.source))
+    for name, value in metric.compare(clt, clt2, args.metrics).items():
+        print("%s %.6f" % (name, value))
+
+def command_experiment(args):
+    if args.split:
+        split_experiment(args.data, args.results, args.metrics, args.alpha)
+    else:
+        run_experiment(args.data, args.results, replications=args.replications, iterations=args.iterations,
+                       seed=args.seed, n_jobs=args.jobs, metrics=args.metrics, perturbation=args.perturbation,
+                       alpha=args.alpha)
+    if args.plot_dir:
+        headless_plots()
+        for path in plot_results(args.results, args.plot_dir):
+            print(path)
 
+def command_sample(args):
+    clt = model(args.model, args.jobs, args.compress, args.sparse)
+    clt.sample(args.rows, args.seed, args.chunk_rows, path=args.out)
 
-    fig2 = plt.figure()
-    ax2 = fig2.add_subplot(111)
-    ax2.scatter(*zip(*divergences2))
+def command_score(args):
+    clt = model(args.model, args.jobs, args.compress, args.sparse)
+    scores = clt.score(load_data(args.data))
+    if args.out:
+        np.savetxt(args.out, scores)
+    print("rows %d mean log likelihood %.6f" % (len(scores), np.mean(scores) if len(scores) else np.nan))
+
+def command_classify(args):
+    features, labels = split_labels(load_data(args.train), args.label)
+    classifier = Chow_Liu_Classifier(alpha=args.alpha).fit(features, labels, args.jobs)
+    test, truth = split_labels(load_data(args.test), args.label)
+    predicted = classifier.predict(test)
+    if args.out:
+        np.savetxt(args.out, classifier.predict_proba(test), header=" ".join(str(value) for value in classifier.classes))
+    print("rows %d classes %d accuracy %.6f" % (len(predicted), len(classifier.classes),
+                                                 np.mean(predicted == truth) if len(predicted) else np.nan))
+
+def command_toy(args):
+    toy_example()
+
+def parser():
+    """
+        Argument parser with one subcommand per task.
     """
-    plt.figure(0)
-    plt.xlabel("Inference")
-    plt.ylabel("jsd")
-    plt.scatter(*zip(*divergences))
-
-    plt.figure(1)
-    plt.xlabel("Inference")
-    plt.ylabel("kld")
-    plt.scatter(*zip(*divergences2))
-
-    plt.figure(2)
-    plt.xlabel("Inference")
-    plt.ylabel("MI")
-    plt.scatter(*zip(*divergences3))
-    
-    plt.show()
-
-    if clt.testing:
-        print("marginal of 0 = A: " + str(clt.marginal_probability('0', 'A')))
-        print("marginal of 0 = G: " + str(clt.marginal_probability('0', 'G')))
-        print("marginal of 1 = A: " + str(clt.marginal_probability('1', 'A')))
-        print("marginal of 1 = C: " + str(clt.marginal_probability('1', 'C')))
-        print("marginal of 2 = C: " + str(clt.marginal_probability('2', 'C')))
-        print("marginal of 2 = T: " + str(clt.marginal_probability('2', 'T')))
-        print("marginal of 2 = G: " + str(clt.marginal_probability('2', 'G')))
-        print("marginal of 3 = C: " + str(clt.marginal_probability('3', 'C')))
-        print("------")
-        print("joint of 0 = A and 1 = A: " + str(clt.joint_probability('0', '1', 'A', 'A')))
-        print("joint of 0 = G and 1 = C: " + str(clt.joint_probability('0', '1', 'G', 'C')))
-        print("joint of 0 = A and 1 = C: " + str(clt.joint_probability('0', '1', 'A', 'C')))
-        print("joint of 1 = A and 2 = A: " + str(clt.joint_probability('1', '2', 'A', 'G')))
-        print("joint of 1 = G and 2 = C: " + str(clt.joint_probability('1', '2', 'C', 'T')))
-        print("joint of 1 = A and 2 = C: " + str(clt.joint_probability('1', '2', 'A', 'C')))
-        print("------")
-        for v in range(len(X)):
-            for u in range(v):
-                print("mi " + str(u) + " and " + str(v) + ": " + str(clt.mutual_information(str(u), str(v))))
-        print('------')
-        print(clt.conditional_probability('1', '0', 'A', 'A'))
-        print(clt.conditional_probability('1', '0', 'C', 'A'))
-        print('----')
-        print(clt.conditional_probability('1', '0', 'A', 'G'))
-        print(clt.conditional_probability('1', '0', 'C', 'G'))
-        print("clt2")
-        print('------')
-        print(clt2.conditional_probability('1', '0', 'A', 'A'))
-        print(clt2.conditional_probability('1', '0', 'C', 'A'))
-        print('----')
-        print(clt2.conditional_probability('1', '0', 'A', 'G'))
-        print(clt2.conditional_probability('1', '0', 'C', 'G'))
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Train, compare and score Chow-Liu trees.")
+    parser.add_argument('--profile', metavar='STATS', help="write per-phase stats of the run to this JSON file")
+    parser.add_argument('--cprofile', metavar='PATH', help="with --profile, also write a cProfile of the run")
+    parser.add_argument('--jobs', type=int, default=1, help="worker processes for the mutual information of wide data, and for the replications of experiment")
+    parser.add_argument('--compress', action='store_true', help="train on distinct data points weighted by their copies")
+    parser.add_argument('--sparse', action='store_true', help="train on binary data with accelerated Chow-Liu (acCL)")
+    commands = parser.add_subparsers(dest='command', required=True)
+    command = commands.add_parser('train', help="build a tree and print its edges (parent child MI)")
+    command.add_argument('data')
+    command.add_argument('--plot', metavar='PATH', help="draw the tree into an image file")
+    command.add_argument('--out', metavar='MODEL', help="save the trained tree to this file")
+    command.add_argument('--weights', metavar='PATH', help="text file with the weight of every data point")
+    command.set_defaults(run=command_train)
+    command = commands.add_parser('compare', help="compare the trees of two data files")
+    command.add_argument('data1')
+    command.add_argument('data2')
+    command.add_argument('--metrics', nargs='+', choices=METRICS, default=METRICS[:3])
+    command.add_argument('--queries', choices=["adjacent", "edges", "pairs"], default="adjacent")
+    command.add_argument('--source', choices=["counts", "tree"], default="counts")
+    command.add_argument('--alpha', type=float, default=0.0, help="Laplace smoothing of the CPTs compared by joint_kld")
+    command.set_defaults(run=command_compare)
+    command = commands.add_parser('experiment', help="run the perturbation experiment")
+    command.add_argument('data')
+    command.add_argument('--results', default='experiment_results.csv', help=".csv or .npz results file")
+    command.add_argument('--replications', type=int, default=1)
+    command.add_argument('--iterations', type=int, default=500)
+    command.add_argument('--seed', type=int, default=0)
+    command.add_argument('--metrics', nargs='+', choices=METRICS, default=COLUMNS[3:],
+                         help="divergences recorded next to the inference similarity")
+    command.add_argument('--perturbation', choices=["cell", "sample"], default="cell",
+                         help="change one random cell, or replace a data point with a sampled one")
+    command.add_argument('--alpha', type=float, default=0.0, help="Laplace smoothing of the CPTs compared by joint_kld")
+    command.add_argument('--split', action='store_true', help="learn two halves of the data online instead")
+    command.add_argument('--plot-dir', help="write the scatter plots to this directory")
+    command.set_defaults(run=command_experiment)
+    command = commands.add_parser('sample', help="draw a synthetic binary data set from a tree")
+    command.add_argument('model', help="tree saved by train --out, or a data file to build the tree on")
+    command.add_argument('out', help="binary data file to write (readable by every other command)")
+    command.add_argument('--rows', type=int, default=1000000)
+    command.add_argument('--seed', type=int, default=0)
+    command.add_argument('--chunk-rows', type=int, default=1 << 20)
+    command.set_defaults(run=command_sample)
+    command = commands.add_parser('score', help="log likelihood of every row of a data file")
+    command.add_argument('model', help="tree saved by train --out, or a data file to build the tree on")
+    command.add_argument('data', help="data file to score")
+    command.add_argument('--out', help="write one log likelihood per line")
+    command.set_defaults(run=command_score)
+    command = commands.add_parser('classify', help="train one tree per class and classify a data file")
+    command.add_argument('train', help="training data file")
+    command.add_argument('test', help="data file to classify")
+    command.add_argument('--label', type=int, required=True, help="index of the label variable")
+    command.add_argument('--alpha', type=float, default=1.0, help="Laplace smoothing of the class trees")
+    command.add_argument('--out', help="write the class probabilities of every row")
+    command.set_defaults(run=command_classify)
+    command = commands.add_parser('toy', help="print probabilities of a small hand-made data set")
+    command.set_defaults(run=command_toy)
+    return parser
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    with profiled_run(args.cprofile) if args.profile else contextlib.nullcontext() as run:
+        args.run(args)
+    if args.profile:
+        run.to_json(args.profile)
+
+if __name__ == "__main__":
+    sys.exit(main())
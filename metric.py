@@ -1,6 +1,128 @@
 import numpy as np
+from inference import Belief_Propagation, ancestral_sample, cumulative_cpts, tree_log_likelihood
+from profiling import profiled, stats
+
+def kl_divergences(p, q):
+    """
+        Kullback-Lieber divergence between every row of p and the same row of q.
+        p and q: matrices with one distribution per row, aligned on the same support.
+        return: vector of divergences (in bits); infinite where q misses mass of p.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = np.where(p > 0, p * np.log2(p / q), 0) # 0 log 0 = 0
+    return np.sum(terms, axis=1)
+
+def aligned_distributions(clt1, clt2):
+    """
+        Put the marginal distributions of both trees on a shared support per variable.
+        clt1 and clt2: the Chow Liu Trees to align.
+        return: two n x max support matrices; row var holds p(var = value) for the
+            union of the values var takes in either tree (zero padded).
+    """
+    distributions1, distributions2 = clt1.distributions(), clt2.distributions()
+    vocab1, vocab2 = clt1.counts.vocab, clt2.counts.vocab
+    supports = [sorted(set(values1.tolist()) | set(values2.tolist())) for values1, values2 in zip(vocab1, vocab2)]
+    size = max(len(support) for support in supports)
+    p, q = np.zeros((len(supports), size)), np.zeros((len(supports), size))
+    for var, support in enumerate(supports):
+        position = dict((value, i) for i, value in enumerate(support))
+        p[var, [position[value] for value in vocab1[var].tolist()]] = distributions1[var]
+        q[var, [position[value] for value in vocab2[var].tolist()]] = distributions2[var]
+    return p, q
+
+def aligned_model(clt, supports, alpha=0.0):
+    """
+        Re-index the CPTs of a tree on per-variable supports.
+        clt: trained Chow Liu Tree.
+        supports: list with the values of each variable to index by (a superset of clt.vocab).
+        alpha: if positive, rebuild the CPTs from the counts of clt with Laplace smoothing over
+            the supports, so no value or combination has probability 0.
+        return: Belief_Propagation over the re-indexed CPTs (zero for values clt never saw).
+    """
+    lookups = []
+    for var, values in enumerate(clt.vocab):
+        position = dict((value, i) for i, value in enumerate(supports[var]))
+        lookups.append(np.array([position[value] for value in values.tolist()], dtype=np.intp))
+    cpts = []
+    for var, cpt in enumerate(clt.cpts):
+        if var == clt.root:
+            full = np.full(len(supports[var]), float(alpha))
+            full[lookups[var]] += clt.counts.marginals[var] if alpha > 0 else cpt
+        else:
+            parent = clt.parents[var]
+            full = np.full((len(supports[parent]), len(supports[var])), float(alpha))
+            full[np.ix_(lookups[parent], lookups[var])] += clt.counts.pair_table(parent, var) if alpha > 0 else cpt
+        if alpha > 0:
+            full /= np.sum(full, axis=-1, keepdims=True)
+        cpts.append(full)
+    return Belief_Propagation(clt.parents, clt.order, cpts)
+
+def expected_log_likelihood(p, q):
+    """
+        Expected log probability (in bits) of tree q under tree p, from the factorization of q
+        and the pairwise marginals of p found by message passing over p.
+        p and q: Belief_Propagation models aligned on the same supports.
+        return: E_p[log2 q(x)], -inf if q misses mass of p.
+    """
+    n = len(p.parents)
+    marginal = p.marginals(np.full((1, n), -1, dtype=np.intp))[q.root][0]
+    terms = [(marginal, q.cpts[q.root])]
+    joints = p.pairwise([(q.parents[child], child) for child in q.order[1:]])
+    terms += [(joints[(q.parents[child], child)], q.cpts[child]) for child in q.order[1:]]
+    total = 0.0
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for mass, probability in terms:
+            total += np.sum(np.where(mass > 0, mass * np.log2(probability), 0)) # 0 log 0 = 0
+    return total
+
+def tree_kld(p, q):
+    """
+        Exact Kullback-Lieber divergence between the joint distributions of two trees.
+        p and q: Belief_Propagation models aligned on the same supports.
+        return: KL(p || q) in bits.
+    """
+    return expected_log_likelihood(p, p) - expected_log_likelihood(p, q)
+
+def mixture_jsd(p, q, samples, rng):
+    """
+        Monte Carlo estimate of the Jensen-Shannon divergence between the joint distributions
+        of two trees. With a fair coin z picking the tree x is drawn from, JS(p, q) = I(z; x)
+        = 1 - E_m[h(p(x) / (p(x) + q(x)))] for the mixture m = (p + q) / 2 and the binary
+        entropy h. Every draw adds a term in [0, 1], so the estimate is always in [0, 1] bits;
+        its standard error is at most 1 / (2 sqrt(samples)).
+        p and q: Belief_Propagation models aligned on the same supports.
+        samples: number of draws, half of them from each tree.
+        rng: numpy random generator.
+        return: estimate of JS(p, q) in bits.
+    """
+    half = max(samples // 2, 1)
+    codes = np.concatenate([ancestral_sample(model.parents, model.order, cumulative_cpts(model.cpts), model.arities, half, rng)
+                            for model in (p, q)])
+    with np.errstate(divide='ignore'):
+        log_p, log_q = [tree_log_likelihood(model.parents, model.order, [np.log(cpt) for cpt in model.cpts], codes)
+                        for model in (p, q)]
+    log_total = np.logaddexp(log_p, log_q)
+    entropy = np.zeros(len(codes))
+    with np.errstate(invalid='ignore'):
+        for log_probability in (log_p, log_q):
+            share = np.exp(log_probability - log_total) # posterior of the tree given x
+            entropy -= np.where(share > 0, share * np.log2(np.where(share > 0, share, 1)), 0)
+    return 1 - np.mean(entropy)
 
 class Metric:
+    def __init__(self, alpha=0.0, samples=4096, seed=0):
+        """
+            Initialization function
+            alpha: Laplace smoothing of the CPTs compared by joint_kld; with 0 the divergence
+                is infinite as soon as the second tree gives probability 0 to something the
+                first one can produce.
+            samples: number of data points drawn to estimate joint_jsd.
+            seed: seed of those draws, so comparing the same trees gives the same value.
+        """
+        self.alpha = alpha
+        self.samples = samples
+        self.seed = seed
+
     def kld(self, var, p, q):
         """
             Calculate the Kullback-Lieber Divergence (semi-metric)
@@ -9,15 +131,8 @@ class Metric:
             return: distance between p and q.
         """
         if len(p) != len(q):
-            return 0
-        quotient = np.divide(p, q)
-        #print(":)))", len(p))
-        #print("dist1:",p)
-        #print("dist2",q)
-        #print(":(((", len(q))
-        log2_quotient = np.log2(quotient)
-        divergence = np.dot(p, log2_quotient)
-        return divergence
+            raise ValueError("p and q must be aligned on the same support")
+        return kl_divergences(np.atleast_2d(p), np.atleast_2d(q))[0]
 
     def jsd(self, var, p, q):
          """
@@ -36,6 +151,9 @@ class Metric:
             p and q: the Chow Liu Trees to compare.
             return: the average percentage of similarity between p and q.
         """
+        for clt in (p, q):
+            if clt.mi_matrix is None: # sparse training only finds the MI of the tree edges
+                clt.compute_mutual_information()
         # get the absolute differences between both distributions' mutual information vectors
         differences = abs(p.mi_vec - q.mi_vec) # each vector contains the MI's between all variables
         # express the distances in terms of similiarities (to be used as percentages of similarity)
@@ -52,57 +170,156 @@ class Metric:
             clt1 and clt2: are the two Chow-Liu Trees to be compared.
             return: the average percentage of divergence between distributions of clt1 and clt2.
         """
-        divergences = []
-        for var, _ in clt1.X.items():
-            # get distibutions for the current variable
-            distribution_1 = clt1.probability_distribution(var)
-            distribution_2 = clt2.probability_distribution(var)
-            # choose a metric
-            if metric == "kld": # kullback-lieber
-                divergence = self.kld(var, distribution_1, distribution_2)
-            elif metric == "jsd": # jensen-shannon
-                divergence = self.jsd(var, distribution_1, distribution_2)
-            elif metric == "mid": # mutual information distance
-                return self.mid(clt1, clt2)
-            # store each result as a percentage of similarity
-            divergences.append(1 - divergence)
-        # return the average divergence
-        return 1.0 * np.sum(divergences) / len(divergences)
-
-    def conditional_probability_tests(self, clt1, clt2, which="all"):
+        return self.compare(clt1, clt2, [metric])[metric]
+
+    def compare(self, clt1, clt2, metrics=("mid", "jsd", "kld")):
+        """
+            Evaluates several divergences between two Chow-Liu Trees in a single pass.
+            clt1 and clt2: are the two Chow-Liu Trees to be compared.
+            metrics: any of "mid" (mutual information), "jsd" (jensen-shannon), "kld" (kullback-lieber),
+                "joint_kld" (exact KL between the joint distributions of the trees, smoothed by
+                self.alpha) and "joint_jsd" (seeded Monte Carlo estimate of the JS between the
+                joint distributions, see mixture_jsd; it does not go through joint_kld).
+            return: dictionary from metric to the average percentage of similarity between clt1 and clt2.
+        """
+        results = {}
+        if "jsd" in metrics or "kld" in metrics:
+            # per-variable distributions on a shared support, one row per variable
+            with stats.phase("metric.align"):
+                p, q = aligned_distributions(clt1, clt2)
+            if "kld" in metrics:
+                with stats.phase("metric.kld"):
+                    results["kld"] = np.mean(1 - kl_divergences(p, q))
+            if "jsd" in metrics:
+                with stats.phase("metric.jsd"):
+                    m = 1./2. * (p + q)
+                    results["jsd"] = np.mean(1 - 1./2. * (kl_divergences(p, m) + kl_divergences(q, m)))
+        if "mid" in metrics:
+            with stats.phase("metric.mid"):
+                results["mid"] = self.mid(clt1, clt2)
+        if "joint_kld" in metrics:
+            with stats.phase("metric.joint_kld"):
+                results["joint_kld"] = 1 - self.joint_kld(clt1, clt2)
+        if "joint_jsd" in metrics:
+            with stats.phase("metric.joint_jsd"):
+                results["joint_jsd"] = 1 - self.joint_jsd(clt1, clt2)
+        unknown = set(metrics) - set(results)
+        if unknown:
+            raise ValueError("unknown metrics: %s" % ", ".join(sorted(unknown)))
+        return results
+
+    def joint_kld(self, clt1, clt2):
+        """
+            Calculate the exact Kullback-Lieber Divergence between the joint distributions of two
+            Chow-Liu Trees, using their factorizations instead of per-variable marginals.
+            clt1 and clt2: the trained Chow-Liu Trees to compare.
+            return: KL(clt1 || clt2) in bits, of the trees smoothed by self.alpha.
+        """
+        p, q = self.aligned_models(clt1, clt2, self.alpha)
+        return tree_kld(p, q)
+
+    def joint_jsd(self, clt1, clt2):
+        """
+            Estimate the Jensen-Shannon Divergence between the joint distributions of two
+            Chow-Liu Trees from self.samples draws of their mixture, seeded with self.seed
+            (see mixture_jsd). The CPTs are compared unsmoothed: the estimate stays finite.
+            clt1 and clt2: the trained Chow-Liu Trees to compare.
+            return: JS(clt1, clt2) in bits, always in [0, 1].
+        """
+        p, q = self.aligned_models(clt1, clt2)
+        return mixture_jsd(p, q, self.samples, np.random.default_rng(self.seed))
+
+    def aligned_models(self, clt1, clt2, alpha=0.0):
+        """
+            Put the CPTs of both trees on the union of the values each variable takes.
+            alpha: Laplace smoothing of the CPTs (see aligned_model).
+        """
+        supports = [sorted(set(values1.tolist()) | set(values2.tolist())) for values1, values2 in zip(clt1.vocab, clt2.vocab)]
+        return aligned_model(clt1, supports, alpha), aligned_model(clt2, supports, alpha)
+
+    @profiled("conditional_probability_tests")
+    def conditional_probability_tests(self, clt1, clt2, which="all", queries="adjacent", source="counts"):
         """
             Runs conditional probability queries for the clt1 and clt2 and comparing results.
             clt1 and clt2: the Chow Liu Trees for running the conditional probability test.
             which: determines wether to run specific queries or all possible conbinations. 
+            queries: the (variable, parent) pairs to query: "adjacent" (consecutive variables),
+                "edges" (the edges of clt1), "pairs" (every ordered pair) or an explicit list.
+            source: "counts" for p(var | par) from the data counts or "tree" for the
+                posterior of var given par by message passing over each tree.
             return: average error in the query results expressed in percentages.
         """
-        if which == "all":
-            # arrays for storing the results of inferences for each clt
-            clt1_inferences = np.array([])
-            clt2_inferences = np.array([])
-            # get all unique values from the distributions
-            values = set([val for _, vals in clt1.X.items() for val in vals])
-            variables = sorted(list(clt1.X.keys()))
-            for i in range(0, len(variables) - 1):
-                current = variables[i + 1]
-                parent = variables[i]
-                for value_cur in values:
-                    for value_par in values:
-                        clt1_inferences = np.append(clt1_inferences, clt1.conditional_probability(current, parent, value_cur, value_par))
-                        clt2_inferences = np.append(clt2_inferences, clt2.conditional_probability(current, parent, value_cur, value_par))
-        elif which == "specific":
+        if which == "specific":
             # this will only work for the toy set
-            clt1_inferences = np.append(clt1_inferences, clt1.conditional_probability('1', '0', 'A', 'A'))
-            clt1_inferences = np.append(clt1_inferences, clt1.conditional_probability('1', '0', 'C', 'A'))
-            clt1_inferences = np.append(clt1_inferences, clt1.conditional_probability('1', '0', 'A', 'G'))
-            clt1_inferences = np.append(clt1_inferences, clt1.conditional_probability('1', '0', 'C', 'G'))
+            combinations = [('A', 'A'), ('C', 'A'), ('A', 'G'), ('C', 'G')]
+            clt1_inferences = np.array([clt1.conditional_probability('1', '0', cur, par) for cur, par in combinations])
+            clt2_inferences = np.array([clt2.conditional_probability('1', '0', cur, par) for cur, par in combinations])
+            return self.query_differences(clt1_inferences, clt2_inferences)
+        pairs = self.query_pairs(clt1, queries)
+        if not pairs:
+            raise ValueError("there are no conditional probability queries to compare")
+        # every value seen in clt1 is queried for every variable against every value of its parent
+        values = np.array(sorted(set([val for vals in clt1.counts.vocab for val in vals.tolist()])))
+        reference = [values] * len(clt1.counts.arities)
+        tables1 = self.conditional_tables(clt1, pairs, reference, source)
+        tables2 = self.conditional_tables(clt2, pairs, reference, source)
+        # queries on values a variable never takes are 0 in both trees and do not add error
+        error = np.sum(np.abs(tables1 - tables2))
+        return 1.0 - 1.0 * error / (len(pairs) * len(values) ** 2)
 
-            clt2_inferences = np.append(clt2_inferences, clt2.conditional_probability('1', '0', 'A', 'A'))
-            clt2_inferences = np.append(clt2_inferences, clt2.conditional_probability('1', '0', 'C', 'A'))
-            clt2_inferences = np.append(clt2_inferences, clt2.conditional_probability('1', '0', 'A', 'G'))
-            clt2_inferences = np.append(clt2_inferences, clt2.conditional_probability('1', '0', 'C', 'G'))
+    def query_pairs(self, clt, queries):
+        """
+            Resolve a query set into (variable, parent) index pairs.
+            clt: Chow Liu Tree providing the variables and tree edges.
+            queries: "adjacent", "edges", "pairs" or a list of (variable, parent) pairs.
+            return: list of (variable, parent) index pairs.
+        """
+        n = len(clt.counts.arities)
+        if queries == "adjacent":
+            return [(var, var - 1) for var in range(1, n)]
+        if queries == "edges":
+            return [(int(child), int(clt.parents[child])) for child in clt.order[1:]]
+        if queries == "pairs":
+            return [(var, par) for var in range(n) for par in range(n) if var != par]
+        return [(int(var), int(par)) for var, par in queries]
 
-        return self.query_differences(clt1_inferences, clt2_inferences)
+    def conditional_tables(self, clt, pairs, reference, source="counts"):
+        """
+            Build the p(var | par) tables of a tree for a set of queries, aligned on reference vocabularies.
+            clt: Chow Liu Tree to query.
+            pairs: list of (variable, parent) index pairs.
+            reference: list with the values of each variable the tables are indexed by.
+            source: "counts" or "tree" (see conditional_probability_tests).
+            return: Q x max arity x max arity array; entry [q, a, b] is p(var = b | par = a)
+                for the a-th and b-th reference values, 0 where a value is unknown to clt.
+        """
+        counts = clt.counts
+        size = max(len(values) for values in reference)
+        tables = np.zeros((len(pairs), size, size))
+        # where each reference value sits in clt's vocabulary (the last slot is a zero pad)
+        lookups = []
+        for var, values in enumerate(reference):
+            lookups.append(np.array([counts.code(var, value) for value in values.tolist()], dtype=np.intp))
+        posteriors = {}
+        if source == "tree":
+            inference = clt.inference()
+            for par in set(par for _, par in pairs):
+                evidence = np.full((counts.arities[par], len(counts.arities)), -1, dtype=np.intp)
+                evidence[:, par] = np.arange(counts.arities[par])
+                targets = [var for var, p in pairs if p == par]
+                for var, posterior in inference.marginals(evidence, targets).items():
+                    posteriors[(var, par)] = posterior
+        for q, (var, par) in enumerate(pairs):
+            if source == "tree":
+                table = posteriors[(var, par)]
+            else:
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    table = counts.pair_table(par, var) / counts.marginals[par][:, None]
+                table[counts.marginals[par] == 0] = 0
+            padded = np.zeros((table.shape[0] + 1, table.shape[1] + 1))
+            padded[:-1, :-1] = table
+            tables[q, :len(lookups[par]), :len(lookups[var])] = padded[lookups[par]][:, lookups[var]]
+        return tables
 
     def query_differences(self, clt1_inferences, clt2_inferences):
         """
@@ -0,0 +1,151 @@
+"""
+Opt-in instrumentation of the hot paths: wall time, call counts and peak memory per phase.
+
+    with profiled_run('run.prof') as run:
+        ...
+    print(run.to_json())
+"""
+import cProfile
+import functools
+import json
+import resource
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+class Run_Stats:
+    def __init__(self):
+        """
+            Initialization function, recording starts disabled.
+        """
+        self.enabled = False
+        self.phases = {} # name -> [calls, seconds, peak traced bytes]
+        self.counters = {}
+        self.peak_memory = None
+        self.stack = [] # running peak of every open phase while tracing memory
+
+    def reset(self):
+        """
+            Forget everything recorded so far.
+        """
+        self.phases, self.counters, self.peak_memory, self.stack = {}, {}, None, []
+
+    def count(self, name, n=1):
+        """
+            Add n to a counter (no-op when disabled).
+        """
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def phase(self, name):
+        """
+            Time a block and count it as a call of the phase; with tracemalloc tracing,
+            also keep the peak of the traced memory (all live allocations) while it runs.
+            name: name of the phase.
+        """
+        if not self.enabled:
+            yield
+            return
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            self.enter_memory()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            record = self.phases.setdefault(name, [0, 0.0, 0])
+            record[0] += 1
+            record[1] += elapsed
+            if tracing and self.stack:
+                record[2] = max(record[2], self.exit_memory())
+
+    def enter_memory(self):
+        """
+            Start measuring the peak of a new phase; the open phases keep the peak so far.
+        """
+        peak = tracemalloc.get_traced_memory()[1]
+        if self.stack:
+            self.stack[-1] = max(self.stack[-1], peak)
+        self.stack.append(0)
+        tracemalloc.reset_peak()
+
+    def exit_memory(self):
+        """
+            Close the innermost phase and pass its peak on to the enclosing one.
+            return: peak traced bytes of the closed phase.
+        """
+        peak = max(self.stack.pop(), tracemalloc.get_traced_memory()[1])
+        if self.stack:
+            self.stack[-1] = max(self.stack[-1], peak)
+        return peak
+
+    def to_dict(self):
+        """
+            Recorded statistics as plain values.
+        """
+        phases = dict((name, {'calls': calls, 'seconds': seconds, 'peak_bytes': peak})
+                      for name, (calls, seconds, peak) in self.phases.items())
+        return {'phases': phases, 'counters': dict(self.counters), 'peak_memory': self.peak_memory}
+
+    def to_json(self, path=None):
+        """
+            Dump the statistics as JSON.
+            path: if given, the file to write.
+            return: the JSON text.
+        """
+        text = json.dumps(self.to_dict(), indent=2, sort_keys=True)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
+
+stats = Run_Stats() # shared by every instrumented function
+
+def profiled(name):
+    """
+        Decorator recording every call of a function as the named phase; when
+        recording is disabled the only cost is one attribute check.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not stats.enabled:
+                return function(*args, **kwargs)
+            with stats.phase(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+@contextmanager
+def profiled_run(profile_path=None, memory=True):
+    """
+        Record the statistics of everything run inside the block.
+        profile_path: if given, a cProfile of the block is written there (read it with pstats).
+        memory: whether to trace allocations with tracemalloc for per-phase peak memory
+            (slows the run down).
+        return: the shared statistics, reset at the start of the block.
+    """
+    stats.reset()
+    stats.enabled = True
+    started_tracing = memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    if tracemalloc.is_tracing():
+        stats.stack.append(0) # the whole run, phases reset the tracemalloc peak
+    profiler = cProfile.Profile() if profile_path else None
+    if profiler:
+        profiler.enable()
+    try:
+        yield stats
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+        stats.peak_memory = {'traced_bytes': stats.exit_memory()} if stats.stack else {}
+        # maximum resident set size of the process, in kilobytes on Linux
+        stats.peak_memory['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if started_tracing:
+            tracemalloc.stop()
+        stats.enabled = False
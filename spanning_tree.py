@@ -0,0 +1,99 @@
+"""
+Spanning tree construction for Chow-Liu trees.
+"""
+import numpy as np
+from collections import deque
+
+def maximum_spanning_tree(weights):
+    """
+        Prim's algorithm on a dense weight matrix, O(n^2) time and O(n) extra memory.
+        weights: n x n symmetric matrix with the weight of every edge.
+        return: list with the n - 1 (u, v) edges of the tree.
+    """
+    n = len(weights)
+    in_tree = np.zeros(n, dtype=bool)
+    best = np.full(n, -np.inf) # heaviest edge from the tree to each node outside of it
+    link = np.zeros(n, dtype=np.intp) # tree node at the other end of that edge
+    edges = []
+    node = 0
+    for _ in range(n - 1):
+        in_tree[node] = True
+        closer = (weights[node] > best) & ~in_tree
+        best[closer] = weights[node][closer]
+        link[closer] = node
+        best[node] = -np.inf
+        node = int(np.argmax(np.where(in_tree, -np.inf, best)))
+        edges.append((int(link[node]), node))
+    return edges
+
+class Union_Find:
+    def __init__(self, n):
+        """
+            Initialization function, every node starts in its own component.
+            n: number of nodes.
+        """
+        self.labels = np.arange(n) # component of every node
+        self.members = [[node] for node in range(n)]
+
+    def union(self, u, v):
+        """
+            Merge the components of u and v, relabeling the smaller one.
+            return: whether they were different components.
+        """
+        a, b = self.labels[u], self.labels[v]
+        if a == b:
+            return False
+        if len(self.members[a]) < len(self.members[b]):
+            a, b = b, a
+        self.labels[self.members[b]] = a
+        self.members[a].extend(self.members[b])
+        self.members[b] = []
+        return True
+
+def kruskal(edges, n, components=None):
+    """
+        Kruskal's algorithm over edges that arrive by decreasing weight, stopping as soon
+        as the tree is complete so the rest of the edges are never generated.
+        edges: iterable of (weight, u, v) in decreasing order of weight.
+        n: number of nodes.
+        components: Union_Find to use (shared with the edge generator), a new one by default.
+        return: list with the n - 1 (u, v) edges of the tree.
+    """
+    components = Union_Find(n) if components is None else components
+    tree = []
+    if n < 2:
+        return tree
+    for _, u, v in edges:
+        if components.union(u, v):
+            tree.append((u, v))
+            if len(tree) == n - 1:
+                break
+    return tree
+
+def orient_tree(edges, n, root=0):
+    """
+        Direct the edges of a tree away from a root with a breadth-first search.
+        edges: list of (u, v) edges.
+        n: number of nodes.
+        root: node the edges point away from.
+        return: vector with the parent of each node (-1 for the root) and the
+            nodes in breadth-first (topological) order.
+    """
+    neighbors = [[] for _ in range(n)]
+    for u, v in edges:
+        neighbors[u].append(v)
+        neighbors[v].append(u)
+    parents = np.full(n, -1, dtype=np.intp)
+    order = [root]
+    visited = np.zeros(n, dtype=bool)
+    visited[root] = True
+    queue = deque([root])
+    while queue:
+        node = queue.popleft()
+        for neighbor in neighbors[node]:
+            if not visited[neighbor]:
+                visited[neighbor] = True
+                parents[neighbor] = node
+                order.append(neighbor)
+                queue.append(neighbor)
+    return parents, np.array(order, dtype=np.intp)
@@ -0,0 +1,135 @@
+"""
+Checks of the training paths of Chow_Liu_Tree against a tree built from scratch.
+
+    python -m pytest -q test_chow_liu_tree.py
+"""
+import itertools
+import numpy as np
+import pytest
+from chow_liu_tree import Chow_Liu_Tree
+from counts import mutual_information_matrix
+from dataset import Dataset
+
+def random_data(rng, n_rows, n_vars, arity=3):
+    """
+        Data set with some dependence between neighbouring variables.
+    """
+    codes = rng.integers(0, arity, (n_rows, n_vars))
+    for var in range(1, n_vars):
+        copy = rng.random(n_rows) < 0.6
+        codes[copy, var] = codes[copy, var - 1]
+    return Dataset(codes, [np.array(['v%d' % value for value in range(arity)])] * n_vars)
+
+def trained(data, **kwargs):
+    clt = Chow_Liu_Tree(data, **kwargs)
+    clt.build_clt()
+    return clt
+
+def assert_same_tree(clt, expected):
+    assert np.array_equal(clt.parents, expected.parents)
+    assert np.allclose(clt.mi_matrix, expected.mi_matrix)
+    for cpt, expected_cpt in zip(clt.cpts, expected.cpts):
+        assert np.allclose(cpt, expected_cpt)
+
+def test_update_and_evict_match_rebuild():
+    rng = np.random.default_rng(0)
+    data = random_data(rng, 400, 8)
+    rows = [data.row_values(row) for row in range(len(data))]
+    clt = trained(data.take(slice(0, 300)))
+    clt.update(rows[300:])
+    assert_same_tree(clt, trained(data))
+    clt.evict(rows[:100])
+    assert_same_tree(clt, trained(data.take(slice(100, 400))))
+
+def test_window_matches_rebuild():
+    rng = np.random.default_rng(1)
+    data = random_data(rng, 300, 6)
+    rows = [data.row_values(row) for row in range(len(data))]
+    clt = trained(data.take(slice(0, 200)), window=150)
+    clt.update(rows[200:])
+    assert_same_tree(clt, trained(data.take(slice(150, 300))))
+    gone = next(row for row in rows[:150] if row not in rows[150:])
+    with pytest.raises(ValueError): # left the window already
+        clt.evict([gone])
+    clt.evict([rows[150]])
+    assert_same_tree(clt, trained(data.take(slice(151, 300))))
+
+def test_evict_rejects_unlearned_points():
+    X = {'0': list('aabba'), '1': list('xyxyx'), '2': list('ppqqp')}
+    clt = trained(X)
+    marginals = [marginal.copy() for marginal in clt.counts.marginals]
+    with pytest.raises(ValueError):
+        clt.evict([['b', 'x', 'q']] * 3)
+    for marginal, expected in zip(clt.counts.marginals, marginals):
+        assert np.array_equal(marginal, expected)
+
+def sparse_binary_data(rng, n_rows, n_vars):
+    """
+        Binary data where 1 is the rare value, with dependence along a random chain.
+    """
+    codes = (rng.random((n_rows, n_vars)) < rng.uniform(0.02, 0.2, n_vars)).astype(np.intp)
+    for var in range(1, n_vars):
+        copy = rng.random(n_rows) < 0.5
+        codes[copy, var] = codes[copy, int(rng.integers(var))]
+    return Dataset(codes, [np.array(['0', '1'])] * n_vars)
+
+def tree_weight(mi_matrix, parents):
+    return sum(mi_matrix[parent, child] for child, parent in enumerate(parents) if parent >= 0)
+
+def prufer_edges(sequence, n):
+    degree = np.ones(n, dtype=int)
+    for node in sequence:
+        degree[node] += 1
+    edges = []
+    for node in sequence:
+        leaf = int(np.flatnonzero(degree == 1)[0])
+        edges.append((leaf, node))
+        degree[leaf] -= 1
+        degree[node] -= 1
+    edges.append(tuple(np.flatnonzero(degree == 1)))
+    return edges
+
+def test_tree_is_a_maximum_spanning_tree():
+    rng = np.random.default_rng(2)
+    for _ in range(5):
+        clt = trained(random_data(rng, 200, 5))
+        heaviest = max(sum(clt.mi_matrix[u, v] for u, v in prufer_edges(sequence, 5))
+                       for sequence in itertools.product(range(5), repeat=3))
+        assert np.isclose(tree_weight(clt.mi_matrix, clt.parents), heaviest)
+
+def test_sparse_tree_has_the_dense_weight():
+    rng = np.random.default_rng(3)
+    for n_vars in (5, 30, 80):
+        data = sparse_binary_data(rng, 2000, n_vars)
+        dense, sparse = trained(data), trained(data, sparse=True)
+        # equal-MI ties may pick different edges, never a lighter tree
+        assert np.isclose(tree_weight(dense.mi_matrix, sparse.parents), tree_weight(dense.mi_matrix, dense.parents))
+        for child in sparse.order[1:]:
+            parent = sparse.parents[child]
+            assert np.allclose(sparse.cpts[child], dense.counts.pair_table(parent, child) / dense.counts.marginals[parent][:, None])
+
+def test_compressed_matches_expanded():
+    rng = np.random.default_rng(4)
+    data = random_data(rng, 600, 6, arity=2) # few distinct data points, many copies
+    expanded, compressed = trained(data), trained(data, compress=True)
+    unique = data.compress()
+    weighted = trained(Dataset(unique.codes, unique.vocab, weights=unique.weights))
+    for clt in (compressed, weighted):
+        assert len(clt.counts.codes) < len(data)
+        assert np.array_equal(clt.mi_matrix, expanded.mi_matrix)
+        assert np.array_equal(clt.parents, expanded.parents)
+        for cpt, expected in zip(clt.cpts, expanded.cpts):
+            assert np.array_equal(cpt, expected)
+
+def test_parallel_matches_serial():
+    rng = np.random.default_rng(5)
+    data = random_data(rng, 500, 40, arity=4)
+    assert np.array_equal(mutual_information_matrix(data.codes, data.arities, n_jobs=2),
+                          mutual_information_matrix(data.codes, data.arities))
+    assert np.array_equal(mutual_information_matrix(data.codes, data.arities, block_size=16),
+                          mutual_information_matrix(data.codes, data.arities))
+    wide = Chow_Liu_Tree(data, max_dense=0) # blocked MI instead of the dense counts
+    wide.build_clt(n_jobs=2)
+    dense = trained(data)
+    assert np.allclose(wide.mi_matrix, dense.mi_matrix)
+    assert np.array_equal(wide.parents, dense.parents)
@@ -0,0 +1,86 @@
+"""
+Checks of the message passing against brute-force enumeration on small trees.
+
+    python -m pytest -q test_inference.py
+"""
+import itertools
+import numpy as np
+from chow_liu_tree import Chow_Liu_Tree
+from inference import Belief_Propagation
+from spanning_tree import orient_tree
+
+def random_tree(rng, n, max_arity=3):
+    """
+        Random tree with random CPTs.
+        return: parents, order and CPTs.
+    """
+    edges = [(int(rng.integers(node)), node) for node in range(1, n)]
+    parents, order = orient_tree(edges, n, int(rng.integers(n)))
+    arities = rng.integers(2, max_arity + 1, n)
+    cpts = [None] * n
+    for node in range(n):
+        shape = (arities[node],) if parents[node] < 0 else (arities[parents[node]], arities[node])
+        cpt = rng.random(shape)
+        cpts[node] = cpt / cpt.sum(axis=-1, keepdims=True)
+    return parents, order, cpts
+
+def joint(parents, cpts, assignment):
+    probability = 1.0
+    for node, code in enumerate(assignment):
+        parent = parents[node]
+        probability *= cpts[node][code] if parent < 0 else cpts[node][assignment[parent], code]
+    return probability
+
+def enumerate_map(parents, cpts, evidence):
+    """
+        Most probable joint assignment consistent with one evidence row, by enumeration.
+        return: its probability.
+    """
+    choices = [range(len(cpt[-1]) if cpt.ndim == 2 else len(cpt)) if code < 0 else [code]
+               for cpt, code in zip(cpts, evidence)]
+    return max(joint(parents, cpts, assignment) for assignment in itertools.product(*choices))
+
+def test_map_matches_enumeration():
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        n = int(rng.integers(2, 7))
+        parents, order, cpts = random_tree(rng, n)
+        engine = Belief_Propagation(parents, order, cpts)
+        arities = [cpt.shape[-1] for cpt in cpts]
+        evidence = np.full((8, n), -1, dtype=np.intp)
+        for row in range(1, len(evidence)): # the first row has no evidence
+            for var in rng.choice(n, int(rng.integers(1, n + 1)), replace=False):
+                evidence[row, var] = rng.integers(arities[var])
+        batch = engine.map(evidence)
+        for row in range(len(evidence)):
+            single = engine.map(evidence[row:row + 1]) # only this row's evidence pattern
+            for result, index in ((batch, row), (single, 0)):
+                assignment = [int(result[var][index]) for var in range(n)]
+                observed = evidence[row] >= 0
+                assert np.array_equal(np.array(assignment)[observed], evidence[row][observed])
+                assert np.isclose(joint(parents, cpts, assignment), enumerate_map(parents, cpts, evidence[row]))
+
+def test_marginals_match_enumeration():
+    rng = np.random.default_rng(1)
+    for _ in range(20):
+        n = int(rng.integers(2, 6))
+        parents, order, cpts = random_tree(rng, n)
+        engine = Belief_Propagation(parents, order, cpts)
+        arities = [cpt.shape[-1] for cpt in cpts]
+        evidence = np.full((1, n), -1, dtype=np.intp)
+        evidence[0, 0] = rng.integers(arities[0])
+        beliefs = engine.marginals(evidence)
+        expected = [np.zeros(arity) for arity in arities]
+        choices = [[evidence[0, 0]]] + [range(arity) for arity in arities[1:]]
+        for assignment in itertools.product(*choices):
+            probability = joint(parents, cpts, assignment)
+            for var, code in enumerate(assignment):
+                expected[var][code] += probability
+        for var in range(n):
+            assert np.allclose(beliefs[var][0], expected[var] / expected[var].sum())
+
+def test_map_of_unobserved_subtree():
+    X = {'0': ['a'] * 6 + ['b'] * 4, '1': ['x', 'y', 'x', 'y', 'x', 'y', 'x', 'x', 'x', 'x']}
+    clt = Chow_Liu_Tree(X)
+    clt.build_clt()
+    assert clt.query(kind='map') == {'0': 'b', '1': 'x'} # p = 0.4, ('a', 'x') has p = 0.3